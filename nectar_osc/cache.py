@@ -0,0 +1,346 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from osc_lib.command import command
+from oslo_config import cfg
+
+from nectar_osc.util import cloud_url
+
+
+CONF = cfg.CONF
+
+
+class Resource(dict):
+    """A cached API resource rehydrated from the persistent store
+
+    The attributes of the original resource are available as items
+    and as attributes.
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class Store:
+    """Persistent SQLite store shared by the caches
+
+    Entries are keyed by the cloud they came from, the cache name and
+    the key, and expire according to the wall clock so they remain
+    valid across processes.  API resources are stored as their
+    attribute dicts and come back as Resource objects.  Values that
+    can't be stored, such as sentinels, are kept in memory only.
+    """
+
+    # Bumped when the table changes; older tables are dropped
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        (version,) = self._db.execute('PRAGMA user_version').fetchone()
+        if version != self.VERSION:
+            self._db.execute('DROP TABLE IF EXISTS entries')
+            self._db.execute(f'PRAGMA user_version = {self.VERSION}')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'cloud TEXT NOT NULL, kind TEXT NOT NULL, key TEXT NOT NULL, '
+            'resource INTEGER NOT NULL, value TEXT NOT NULL, expires REAL, '
+            'PRIMARY KEY (cloud, kind, key))'
+        )
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get(self, cloud, kind, key):
+        """Return the (value, expiry time) stored for 'key' or None
+
+        The expiry is a time.time() value, or None for no expiry.
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT resource, value, expires FROM entries '
+                'WHERE cloud = ? AND kind = ? AND key = ?',
+                (cloud, kind, key),
+            ).fetchone()
+            if row is None:
+                return None
+            (resource, value, expires) = row
+            if expires is not None and expires <= time.time():
+                self._db.execute(
+                    'DELETE FROM entries '
+                    'WHERE cloud = ? AND kind = ? AND key = ?',
+                    (cloud, kind, key),
+                )
+                self._db.commit()
+                return None
+        value = json.loads(value)
+        return (Resource(value) if resource else value, expires)
+
+    def set(self, cloud, kind, key, value, ttl=None):
+        if isinstance(value, Resource):
+            resource = True
+        elif hasattr(value, 'to_dict'):
+            (resource, value) = (True, value.to_dict())
+        elif isinstance(value, (dict, list, str, int, float, bool)):
+            resource = False
+        elif hasattr(value, '__dict__'):
+            (resource, value) = (True, vars(value))
+        else:
+            return
+        try:
+            value = json.dumps(value)
+        except TypeError:
+            return
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                (cloud, kind, key, resource, value, expires),
+            )
+            self._db.commit()
+
+    def delete(self, kind=None, keys=None):
+        """Remove entries of every cloud, optionally of one kind or key
+
+        Returns the number of entries removed.
+        """
+        clauses = []
+        params = []
+        if kind:
+            clauses.append('kind = ?')
+            params.append(kind)
+        if keys:
+            clauses.append(f"key IN ({', '.join('?' * len(keys))})")
+            params.extend(keys)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+        with self._lock:
+            count = self._db.execute(
+                f'DELETE FROM entries{where}', params
+            ).rowcount
+            self._db.commit()
+        return count
+
+
+_store = None
+_store_lock = threading.Lock()
+# The auth URL of the cloud that the cached resources come from
+_cloud = None
+
+
+def use_cloud(identity):
+    """Note the cloud of an identity client, to scope the persistent store
+
+    Names such as role and project names mean different things in
+    different clouds, so stored entries are kept apart by the cloud's
+    auth URL.  Nothing is persisted while the cloud isn't known.
+    """
+    global _cloud
+    _cloud = cloud_url(identity)
+
+
+def get_store():
+    "Return the shared persistent store, or None if it is disabled"
+    global _store
+    if not CONF.cache.persistent or _cloud is None:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = Store(os.path.expanduser(CONF.cache.path))
+    return _store
+
+
+class Cache:
+    """Thread-safe LRU cache with a size bound and an entry TTL
+
+    When 'max_size' or 'ttl' are not given they are taken from the
+    [cache] config group the first time they are needed, so caches can
+    be created at import time.  A 'max_size' or 'ttl' of 0 means no
+    limit.  Lookups are counted so that the effectiveness of the cache
+    can be reported with stats().
+
+    A 'persistent' cache is backed by the shared Store when that is
+    enabled in the config, and entries missing from memory are loaded
+    from it.  Loaded entries keep the expiry they were stored with.
+    """
+
+    def __init__(self, name, max_size=None, ttl=None, persistent=False):
+        self.name = name
+        self._max_size = max_size
+        self._ttl = ttl
+        self.persistent = persistent
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+
+    @property
+    def max_size(self):
+        if self._max_size is None:
+            self._max_size = CONF.cache.max_size
+        return self._max_size
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            self._ttl = CONF.cache.ttl
+        return self._ttl
+
+    @property
+    def store(self):
+        return get_store() if self.persistent else None
+
+    def _lookup(self, key):
+        "Return the (expiry, value) for 'key' or None; caller holds the lock"
+        entry = self._data.get(key)
+        if entry is not None and (
+            entry[0] is None or entry[0] > time.monotonic()
+        ):
+            self._data.move_to_end(key)
+            return entry
+        self._data.pop(key, None)
+        store = self.store
+        stored = store.get(_cloud, self.name, key) if store else None
+        if stored is None:
+            return None
+        (value, expires) = stored
+        self.loads += 1
+        ttl = None if expires is None else max(expires - time.time(), 1e-6)
+        self._insert(key, value, ttl)
+        return self._data[key]
+
+    def _insert(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expiry = time.monotonic() + ttl if ttl else None
+        max_size = self.max_size
+        self._data[key] = (expiry, value)
+        self._data.move_to_end(key)
+        while max_size and len(self._data) > max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[1]
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            return entry[1]
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._insert(key, value)
+        store = self.store
+        if store:
+            store.set(_cloud, self.name, key, value, self.ttl)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+    def update(self, mapping):
+        for key, value in mapping.items():
+            self[key] = value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        "Drop all the entries and reset the counters"
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.loads = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'loads': self.loads,
+            }
+
+
+class InvalidateCache(command.Command):
+    """Remove entries from the persistent identity cache"""
+
+    log = logging.getLogger(__name__ + '.InvalidateCache')
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument(
+            '--kind',
+            choices=['project', 'user', 'role', 'assignment'],
+            help='Only remove entries of this kind',
+        )
+        parser.add_argument(
+            'keys',
+            nargs='*',
+            metavar='<name-or-id>',
+            help='Only remove the entries for these names or ids',
+        )
+        return parser
+
+    def take_action(self, args):
+        self.log.debug('take_action(%s)', args)
+        path = os.path.expanduser(CONF.cache.path)
+        if not os.path.exists(path):
+            print(f"No cache file {path}")
+            return
+        store = Store(path)
+        try:
+            count = store.delete(kind=args.kind, keys=args.keys)
+        finally:
+            store.close()
+        print(f"Removed {count} entries from {path}")
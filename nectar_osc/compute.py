@@ -12,17 +12,35 @@
 #
 
 import collections
+import collections.abc
+from concurrent import futures
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 import json
-
+import os
+import random
+import re
+import threading
+import time
+
+from keystoneauth1 import exceptions as ks_exceptions
+from keystoneclient.exceptions import NotFound
+from openstack import exceptions as sdk_exceptions
 from openstackclient.compute.v2 import server as osc_server
 from oslo_config import cfg
 from prettytable import PrettyTable
 
 from nectar_osc.identity import get_project
 from nectar_osc.identity import get_user
+from nectar_osc.util import IPMatcher
 
 CONF = cfg.CONF
 
+# How many unmatched servers can be listed before the listing position
+# is written to the checkpoint
+CHECKPOINT_INTERVAL = 100
+
 
 def _format_instance(d, style=None):
     """Pretty print instance info for the command line"""
@@ -71,16 +89,67 @@ def show_instance(clients, instance_id, style=None):
     return _format_instance(data, style=style)
 
 
-def extract_server_info(clients, server):
+class InstanceRecord(collections.abc.Mapping):
+    """The information extracted about a server for a mailout
+
+    This behaves like a (mostly) read-only dictionary, so it can be used
+    in templates and dumped as YAML, but it uses slots rather than a
+    per-instance dict to keep large mailouts compact.
+    """
+
+    __slots__ = (
+        'id',
+        'name',
+        'status',
+        'flavor',
+        'host',
+        'full_host',
+        'zone',
+        'image',
+        'user',
+        'project',
+        'addresses',
+        'project_name',
+        'email',
+        'fullname',
+    )
+
+    def __init__(self, **kwargs):
+        for key in self.__slots__:
+            setattr(self, key, kwargs.pop(key, None))
+        if kwargs:
+            raise TypeError(f"Unknown instance fields: {sorted(kwargs)}")
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        return f"InstanceRecord({dict(self)!r})"
+
+
+def extract_server_info(clients, server, resolve=True):
     """Extract server information for mailout.
 
     Extract and massage information about a server, the user that
     launched it, its project and its image.  Return the information
-    as a dictionary.
+    as an InstanceRecord.  If 'resolve' is False the project and user
+    details are left for resolve_identity to fill in later.
     """
 
-    server_info = collections.defaultdict(dict)
-    identity = clients.identity
+    server_info = InstanceRecord()
     try:
         server_info['id'] = server.id
         server_info['name'] = server.name
@@ -114,26 +183,38 @@ def extract_server_info(clients, server):
             server_info['project'] = server.project_id
 
         server_info['addresses'] = _extract_ip(server)
+    except KeyError as e:
+        raise type(e)(f'{e.message} missing in context: {server.to_dict()}')
+    if resolve:
+        resolve_identity(clients, server_info)
+    return server_info
 
-        project = get_project(identity, server_info['project'], use_cache=True)
-        server_info['project_name'] = project.name
 
-        user = get_user(identity, server_info['user'], use_cache=True)
+def resolve_identity(clients, server_info):
+    """Fill in the project name and user details of an InstanceRecord
 
-        # Handle instances created by jenkins/tempest and users without
-        # a fullname.  Also set disabled user's email/fullname as None
-        # so that we don't notify them.  (SC - revisit this logic.)
-        if not user.enabled:
-            server_info['email'] = None
-            server_info['fullname'] = None
-        elif getattr(user, 'email', None):
-            server_info['email'] = user.email
-            server_info['fullname'] = getattr(user, 'full_name', None)
-        else:
-            server_info['email'] = user.name
-            server_info['fullname'] = None
-    except KeyError as e:
-        raise type(e)(f'{e.message} missing in context: {server.to_dict()}')
+    The lookups go via the identity caches, so resolving many records
+    costs one Keystone request per distinct project and user.
+    """
+
+    identity = clients.identity
+    project = get_project(identity, server_info['project'], use_cache=True)
+    server_info['project_name'] = project.name
+
+    user = get_user(identity, server_info['user'], use_cache=True)
+
+    # Handle instances created by jenkins/tempest and users without
+    # a fullname.  Also set disabled user's email/fullname as None
+    # so that we don't notify them.  (SC - revisit this logic.)
+    if not user.enabled:
+        server_info['email'] = None
+        server_info['fullname'] = None
+    elif getattr(user, 'email', None):
+        server_info['email'] = user.email
+        server_info['fullname'] = getattr(user, 'full_name', None)
+    else:
+        server_info['email'] = user.name
+        server_info['fullname'] = None
     return server_info
 
 
@@ -146,12 +227,140 @@ def _extract_ip(server):
     return list(addresses)
 
 
+def _transient_error(e):
+    """Is 'e' a failure that might not happen if the request is retried?"""
+    if isinstance(e, ks_exceptions.ConnectionError):
+        return True
+    if isinstance(e, sdk_exceptions.HttpException):
+        return e.status_code is None or e.status_code >= 500
+    return False
+
+
+class PageSizer:
+    """Choose Nova page sizes from the observed response times
+
+    The page size is doubled while full pages come back well within
+    the target latency, and halved when a page is slow or fails.
+    """
+
+    def __init__(self, initial, minimum, maximum, target):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.target = target
+        self.size = min(max(initial, self.minimum), self.maximum)
+
+    def record(self, count, elapsed):
+        if elapsed > self.target:
+            self.size = max(self.size // 2, self.minimum)
+        elif elapsed < self.target / 2 and count >= self.size:
+            self.size = min(self.size * 2, self.maximum)
+
+    def failed(self):
+        """Shrink after a failure; returns False if we can't shrink"""
+        if self.size <= self.minimum:
+            return False
+        self.size = max(self.size // 2, self.minimum)
+        return True
+
+
+def _backoff(attempt):
+    """Sleep before retry 'attempt', with exponential backoff and jitter"""
+    delay = CONF.nova.page_retry_delay * 2 ** (attempt - 1)
+    time.sleep(random.uniform(0, delay))
+
+
+class ListingCheckpoint:
+    """Append-only record of the progress of an instance listing
+
+    Each line holds a JSON object with the listing position (the source
+    index and the last server id consumed from it) and, optionally, an
+    instance record that was produced.  Records are written before they
+    are produced, so an interrupted listing can be resumed from the
+    last position without losing or repeating instances.  The first
+    line records when the listing started, so that an old checkpoint
+    isn't resumed with a stale list of instances.
+    """
+
+    COMPLETE = 'complete'
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def is_stale(self, now=None):
+        """Was the listing started more than the checkpoint TTL ago?"""
+        try:
+            with open(self.path) as f:
+                started = json.loads(f.readline())['started']
+        except (FileNotFoundError, ValueError, KeyError):
+            return True
+        now = now or datetime.now(timezone.utc)
+        ttl = timedelta(hours=CONF.mailout.checkpoint_ttl)
+        return now - datetime.fromisoformat(started) > ttl
+
+    def load(self):
+        """Return the saved records and the position to resume from"""
+        records = []
+        position = None
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A partial line from an interrupted write
+                        break
+                    if 'position' not in entry:
+                        continue
+                    if 'instance' in entry:
+                        records.append(InstanceRecord(**entry['instance']))
+                    position = entry['position']
+        except FileNotFoundError:
+            pass
+        if isinstance(position, list):
+            position = tuple(position)
+        return (records, position)
+
+    def open(self):
+        self.file = open(self.path, 'a', buffering=1)
+        if self.file.tell() == 0:
+            started = datetime.now(timezone.utc).isoformat()
+            self._write({'started': started})
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def add(self, record, position):
+        self._write({'position': position, 'instance': dict(record)})
+
+    def mark(self, position):
+        self._write({'position': position})
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry) + '\n')
+
+
+def service_project_id(identity, name):
+    """Return the (cached) id of a service project such as 'trove'"""
+    try:
+        return get_project(identity, name, use_cache=True).id
+    except NotFound:
+        return None
+
+
 def all_instances(clients, **kwargs):
     return InstanceExtractor(clients, **kwargs).all()
 
 
-class ReachedLimit(Exception):
-    pass
+def iter_instances(clients, **kwargs):
+    return InstanceExtractor(clients, **kwargs).iter()
 
 
 class InstanceExtractor:
@@ -166,16 +375,36 @@ class InstanceExtractor:
         project_id=None,
         user_id=None,
         limit=None,
+        workers=None,
+        extract_workers=None,
+        changes_since=None,
+        inventory=None,
+        checkpoint=None,
+        defer_identity=False,
     ):
         self.clients = clients
         self.zones = zones
         self.hosts = hosts
         self.status = status
         self.ips = ips
+        self.ip_matcher = IPMatcher(ips) if ips else None
+        # Nova can only filter by single addresses, not by networks
+        if ips and CONF.nova.ip_pushdown:
+            self.pushdown_ips = self.ip_matcher.addresses()
+        else:
+            self.pushdown_ips = None
         self.image_id = image_id
         self.project_id = project_id
         self.user_id = user_id
         self.limit = limit
+        self.workers = workers or CONF.nova.list_workers
+        self.extract_workers = extract_workers or CONF.mailout.extract_workers
+        self.changes_since = changes_since
+        self.inventory = inventory
+        self.checkpoint = checkpoint
+        # Leave the identity lookups to the caller; see resolve_identity
+        self.defer_identity = defer_identity
+        self.count = 0
 
     def get_opts(self):
         opts = {"all_projects": True}
@@ -189,79 +418,347 @@ class InstanceExtractor:
             opts['user_id'] = self.user_id
         if self.project_id:
             opts['project_id'] = self.project_id
+        if self.changes_since:
+            opts['changes_since'] = self.changes_since
+        # Let Nova do the zone and IP filtering where it can be done
+        # in one request.  Multiple values are handled by _queries.
+        if self.zones and len(self.zones) == 1:
+            opts.update(self._zone_opt(self.zones[0]))
+        if self.pushdown_ips and len(self.pushdown_ips) == 1:
+            opts.update(self._ip_opt(self.pushdown_ips[0]))
         return opts
 
+    @staticmethod
+    def _zone_opt(zone):
+        # Nova's 'availability_zone' filter is matched as a regex
+        return {'availability_zone': f'^{re.escape(zone)}$'}
+
+    @staticmethod
+    def _ip_opt(ip):
+        # These are Nova's 'ip' and 'ip6' filters.  They are matched
+        # against the fixed addresses as regexes, or as substrings when
+        # Neutron does the filtering, so the plain address is only a
+        # rough pre-filter for the IPMatcher.
+        if ':' in ip:
+            return {'ipv6_address': ip}
+        else:
+            return {'ipv4_address': ip}
+
+    def _queries(self):
+        """Return the list of Nova search opts that cover the criteria
+
+        Nova only accepts one compute host, zone or IP address per
+        request, so one request is issued per value.  Only one of these
+        is expanded (hosts, then IPs, then zones) to avoid a cross
+        product of requests; the others are checked client-side.
+        """
+
+        opts = self.get_opts()
+        if self.hosts:
+            return [dict(opts, compute_host=host) for host in self.hosts]
+        elif self.pushdown_ips and len(self.pushdown_ips) > 1:
+            return [dict(opts, **self._ip_opt(ip)) for ip in self.pushdown_ips]
+        elif self.zones and len(self.zones) > 1:
+            return [dict(opts, **self._zone_opt(z)) for z in self.zones]
+        else:
+            return [opts]
+
     def all(self):
-        self.res = []
+        self.res = list(self.iter())
+        return self.res
+
+    def iter(self):
+        """Generate extracted server info as the servers are listed
+
+        Servers are extracted as the Nova pages arrive, so consumers
+        can start work before the listing is complete.  Listing stops
+        as soon as 'limit' instances have been produced.  When there is
+        an inventory, the instances are taken from it instead of Nova.
+        When there is a checkpoint, the instances it holds are produced
+        first and the listing carries on from where it was interrupted.
+        """
+
         self.count = 0
+        if self.inventory is not None:
+            yield from self._inventory_instances()
+            return
+
+        start = None
+        seen = set()
+        if self.checkpoint:
+            (records, start) = self.checkpoint.load()
+            for record in records:
+                if self.limit and self.count >= self.limit:
+                    return
+                seen.add(record.id)
+                self.count += 1
+                yield record
+            if start == ListingCheckpoint.COMPLETE:
+                return
+            self.checkpoint.open()
+
+        self.unsaved = 0
+        pending = collections.deque()
+        if self.extract_workers > 1:
+            pool = futures.ThreadPoolExecutor(max_workers=self.extract_workers)
+        else:
+            pool = None
 
+        complete = True
         try:
-            # When using all the searching opts other than project or user,
-            # trove instances will be returned by default via nova list api.
-            # But they will not when search_opts contain project or user.
-            # In order to include them, searching all the instances under
-            # project "trove" and filtering them by the instance metadata.
-            if self.project_id or self.user_id:
-                for server in self._trove_instances():
-                    self._final_processing(server)
-
-            if self.hosts:
-                for host in self.hosts:
-                    for server in self._host_instances(host):
-                        self._final_processing(server)
-            else:
-                for server in self._instances():
-                    self._final_processing(server)
-        except ReachedLimit:
-            pass
-        return self.res
+            for position, server in self._positioned_servers(start, seen):
+                if not (
+                    self._match_az(server) and self._match_ip_address(server)
+                ):
+                    self._skip(position, pending)
+                    continue
+                self.count += 1
+                if pool:
+                    pending.append(
+                        (
+                            position,
+                            pool.submit(
+                                extract_server_info,
+                                self.clients,
+                                server=server,
+                                resolve=not self.defer_identity,
+                            ),
+                        )
+                    )
+                    # Keep a bounded number of extractions in flight so
+                    # that the lookups overlap with the Nova paging.
+                    while len(pending) > self.extract_workers * 2:
+                        (pos, job) = pending.popleft()
+                        yield self._save(pos, job.result())
+                else:
+                    record = extract_server_info(
+                        self.clients,
+                        server=server,
+                        resolve=not self.defer_identity,
+                    )
+                    yield self._save(position, record)
+                if self.limit and self.count >= self.limit:
+                    complete = False
+                    break
+            while pending:
+                (pos, job) = pending.popleft()
+                yield self._save(pos, job.result())
+            if self.checkpoint and complete:
+                self.checkpoint.mark(ListingCheckpoint.COMPLETE)
+        finally:
+            if pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+            if self.checkpoint:
+                self.checkpoint.close()
+
+    def _skip(self, position, pending):
+        """Note a server that didn't match, checkpointing now and then"""
+        self.unsaved += 1
+        if (
+            self.checkpoint
+            and not pending
+            and self.unsaved >= CHECKPOINT_INTERVAL
+        ):
+            self.checkpoint.mark(position)
+            self.unsaved = 0
+
+    def _save(self, position, record):
+        """Checkpoint a record before it is produced"""
+        if self.checkpoint:
+            self.checkpoint.add(record, position)
+            self.unsaved = 0
+        return record
+
+    def _inventory_instances(self):
+        for record in self.inventory:
+            if self._match_record(record):
+                self.count += 1
+                yield record
+                if self.limit and self.count >= self.limit:
+                    break
+
+    def servers(self):
+        """Generate the Nova servers that match the search criteria"""
+        for _, server in self._positioned_servers():
+            yield server
+
+    def _sources(self):
+        """Return the (search opts, filter) pairs for the Nova listings"""
+
+        queries = self._queries()
+        sources = []
+        # When using all the searching opts other than project or user,
+        # trove instances will be returned by default via nova list api.
+        # But they will not when search_opts contain project or user.
+        # In order to include them, searching all the instances under
+        # project "trove" and filtering them by the instance metadata.
+        # That isn't needed if there is no trove project, or if it is
+        # the project being searched.
+        if self.project_id or self.user_id:
+            trove_id = service_project_id(self.clients.identity, 'trove')
+            if trove_id and trove_id != self.project_id:
+                for opts in queries:
+                    opts = dict(opts, project_id=trove_id)
+                    opts.pop('user_id', None)
+                    sources.append((opts, self._match_proj_user))
+        sources.extend((opts, None) for opts in queries)
+        return sources
+
+    def _positioned_servers(self, start=None, seen=None):
+        """Generate (position, server) for the servers in all sources
+
+        The position is the source index and the server id, which is the
+        marker needed to resume the listing after that server.  Listing
+        begins after the 'start' position, if given.  Servers that are
+        in 'seen' or that have already been generated by another source
+        are skipped; e.g. an instance with addresses in two of the
+        requested IP ranges.
+        """
 
-    def _final_processing(self, server):
-        if self.limit and self.count >= self.limit:
-            raise ReachedLimit()
-        if self._match_az(server) and self._match_ip_address(server):
-            self.res.append(extract_server_info(self.clients, server=server))
-            self.count += 1
+        seen = set() if seen is None else seen
+        for index, server in self._query_instances(self._sources(), start):
+            if server.id not in seen:
+                seen.add(server.id)
+                yield ((index, server.id), server)
 
-    def _instances(self, opts=None):
+    def _instances(self, opts=None, marker=None, exact=False):
         """Generate all instances matching search criteria 'opts'
 
         When 'opts' is not supplied, generate them.  The generator
-        deals with paging through the servers returned by Nova.
+        deals with paging through the servers returned by Nova, starting
+        after 'marker' if given.  Transient failures are retried from
+        the last good marker, after a backoff.  Paging stops once the
+        limit has been reached.  If every server listed will be 'exact'
+        matches, the page size is also cut down to the number of
+        instances still needed.
         """
 
         if opts is None:
             opts = self.get_opts()
-        marker = None
+        page_size = opts.get('limit')
+        if CONF.nova.adaptive_paging:
+            sizer = PageSizer(
+                CONF.nova.page_size,
+                CONF.nova.min_page_size,
+                CONF.nova.max_page_size,
+                CONF.nova.target_page_latency,
+            )
+        else:
+            sizer = None
+        # For some instances stuck in build phase, servers.list api will
+        # always return the marker instance.  Stop when a page has
+        # nothing new in it to avoid the dead loop.
+        seen = set()
+        attempt = 0
         while True:
+            remaining = self._remaining()
+            if remaining == 0:
+                break
             if marker:
                 opts['marker'] = marker
-            instances = list(self.clients.compute.servers(**opts))
+            size = sizer.size if sizer else page_size
+            if (
+                exact
+                and remaining is not None
+                and (not size or remaining < size)
+            ):
+                size = remaining
+            if size:
+                opts['limit'] = size
+            start = time.monotonic()
+            try:
+                instances = list(self.clients.compute.servers(**opts))
+            except Exception as e:
+                if (
+                    not _transient_error(e)
+                    or attempt >= CONF.nova.page_retries
+                ):
+                    raise
+                attempt += 1
+                # A page that is too big can time out; try a smaller one
+                if sizer:
+                    sizer.failed()
+                _backoff(attempt)
+                continue
+            attempt = 0
+            if sizer:
+                sizer.record(len(instances), time.monotonic() - start)
+            instances = [i for i in instances if i.id not in seen]
             if not instances:
                 break
-            # for some instances stuck in build phase, servers.list api
-            # will always return the marker instance. Add old marker and
-            # new marker comparison to avoid the dead loop
-            marker_new = instances[-1].id
-            if marker == marker_new:
-                break
-            marker = marker_new
+            seen.update(i.id for i in instances)
+            marker = instances[-1].id
 
             yield from instances
 
-    def _host_instances(self, host):
-        opts = self.get_opts()
-        opts['compute_host'] = host
-        yield from self._instances(opts)
-
-    def _trove_instances(self):
-        opts = self.get_opts()
-        opts.pop('user_id', None)
-        opts['project_id'] = get_project(self.clients.identity, 'trove').id
-        for server in self._instances(opts):
-            if self._match_proj_user(server):
+    def _source_instances(self, source, marker=None):
+        (opts, match) = source
+        exact = match is None and self._exact(opts)
+        for server in self._instances(dict(opts), marker, exact):
+            if match is None or match(server):
                 yield server
 
+    def _remaining(self):
+        """Return how many more instances are needed; None if no limit"""
+        if not self.limit:
+            return None
+        return max(self.limit - self.count, 0)
+
+    def _exact(self, opts):
+        """Will all the servers listed with 'opts' be produced?
+
+        This is the case when the client-side checks in 'iter' have all
+        been pushed down to Nova.  The IP address filters that Nova does
+        are not exact.
+        """
+        if self.zones and 'availability_zone' not in opts:
+            return False
+        return not self.ips
+
+    def _query_instances(self, sources, start=None):
+        """Generate (index, server) for each of the listing 'sources'
+
+        With more than one worker, the sources are paged concurrently
+        and the results are merged back in source order, so that the
+        output is the same as for a serial listing.  The concurrent
+        listings are stopped between pages when the consumer stops, e.g.
+        at the limit.
+        """
+
+        (first, marker) = start or (0, None)
+        markers = {first: marker}
+        indexes = range(first, len(sources))
+        if self.workers <= 1 or len(indexes) <= 1:
+            for i in indexes:
+                for server in self._source_instances(
+                    sources[i], markers.get(i)
+                ):
+                    yield (i, server)
+            return
+
+        stop = threading.Event()
+
+        def list_source(i):
+            servers = []
+            for server in self._source_instances(sources[i], markers.get(i)):
+                if stop.is_set():
+                    break
+                servers.append(server)
+            return servers
+
+        pool = futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            jobs = [(i, pool.submit(list_source, i)) for i in indexes]
+            for i, job in jobs:
+                for server in job.result():
+                    yield (i, server)
+        finally:
+            # We get here early when the consumer has reached its limit
+            # or failed.  Don't run the remaining queries, and wait for
+            # the running ones to stop so none are left paging Nova.
+            stop.set()
+            pool.shutdown(wait=True, cancel_futures=True)
+
     def _match_proj_user(self, server):
         if self.project_id:
             if (
@@ -274,6 +771,9 @@ class InstanceExtractor:
                 return False
         return True
 
+    # The zone and IP address checks are a safety net for the filtering
+    # that has been pushed down to Nova, and they handle the criteria
+    # that were not pushed down.
     def _match_az(self, server):
         if self.zones:
             return server["OS-EXT-AZ:availability_zone"] in self.zones
@@ -281,14 +781,27 @@ class InstanceExtractor:
             return True
 
     def _match_ip_address(self, server):
-        if not self.ips:
+        return self._match_addresses(_extract_ip(server))
+
+    def _match_addresses(self, addresses):
+        if not self.ip_matcher:
             return True
-        for ip in self.ips:
-            if any(
-                map(
-                    lambda a: any(map(lambda aa: ip in aa['addr'], a)),
-                    server.addresses.values(),
-                )
-            ):
-                return True
-        return False
+        return self.ip_matcher.match_any(addresses)
+
+    def _match_record(self, record):
+        """Apply all of the search criteria to an InstanceRecord"""
+
+        if self.status and self.status != 'ALL':
+            if record.status != self.status:
+                return False
+        if self.image_id and record.image != self.image_id:
+            return False
+        if self.user_id and record.user != self.user_id:
+            return False
+        if self.project_id and record.project != self.project_id:
+            return False
+        if self.hosts and record.host not in self.hosts:
+            return False
+        if self.zones and record.zone not in self.zones:
+            return False
+        return self._match_addresses(record.addresses)
@@ -37,6 +37,51 @@ mailout_opts = [
         default='~/.cache/os-mailout/freshdesk/',
         help='default working directory; i.e. where mailout dirs are created',
     ),
+    cfg.IntOpt(
+        'extract_workers',
+        default=1,
+        min=1,
+        help=(
+            'number of instances whose project and user details are '
+            'looked up concurrently when preparing a mailout'
+        ),
+    ),
+    cfg.IntOpt(
+        'render_workers',
+        default=1,
+        min=1,
+        help=(
+            'number of processes that render and save notifications '
+            'concurrently when preparing a mailout'
+        ),
+    ),
+    cfg.IntOpt(
+        'inventory_ttl',
+        default=24,
+        min=0,
+        help=(
+            'age in hours after which the instance inventory snapshot is '
+            'rebuilt rather than refreshed with the recent changes'
+        ),
+    ),
+    cfg.IntOpt(
+        'checkpoint_ttl',
+        default=24,
+        min=0,
+        help=(
+            'age in hours after which an instance listing checkpoint is '
+            'discarded rather than resumed'
+        ),
+    ),
+    cfg.IntOpt(
+        'recipient_index_ttl',
+        default=1,
+        min=0,
+        help=(
+            'age in hours after which the saved project recipient index '
+            'is rebuilt'
+        ),
+    ),
 ]
 
 nova_opts = [
@@ -45,12 +90,112 @@ nova_opts = [
         default='-1',
         help='nova result page size when listing instances',
     ),
+    cfg.BoolOpt(
+        'adaptive_paging',
+        default=False,
+        help=(
+            'adjust the nova page size to the observed response times, '
+            'within min_page_size and max_page_size'
+        ),
+    ),
+    cfg.IntOpt(
+        'min_page_size',
+        default=100,
+        min=1,
+        help='smallest nova page size used by adaptive paging',
+    ),
+    cfg.IntOpt(
+        'max_page_size',
+        default=2000,
+        min=1,
+        help='largest nova page size used by adaptive paging',
+    ),
+    cfg.FloatOpt(
+        'target_page_latency',
+        default=10.0,
+        min=0.1,
+        help=(
+            'nova response time in seconds that adaptive paging aims '
+            'to stay under'
+        ),
+    ),
+    cfg.IntOpt(
+        'page_retries',
+        default=3,
+        min=0,
+        help=(
+            'number of times a failed nova page request is retried '
+            'before the listing is abandoned'
+        ),
+    ),
+    cfg.FloatOpt(
+        'page_retry_delay',
+        default=2.0,
+        min=0,
+        help=(
+            'initial delay in seconds before retrying a failed nova page '
+            'request; the delay doubles with each retry and is jittered'
+        ),
+    ),
+    cfg.IntOpt(
+        'list_workers',
+        default=1,
+        min=1,
+        help=(
+            'number of concurrent nova listings when instances are '
+            'gathered from several compute hosts, zones or IP addresses'
+        ),
+    ),
+    cfg.BoolOpt(
+        'ip_pushdown',
+        default=False,
+        help=(
+            'pass single --ip addresses to nova as a pre-filter; nova only '
+            'searches fixed addresses, so floating IPs are not found when '
+            'this is enabled'
+        ),
+    ),
+]
+
+cache_opts = [
+    cfg.IntOpt(
+        'max_size',
+        default=100000,
+        min=0,
+        help=(
+            'maximum number of entries held in each of the project, user '
+            'and role caches; 0 means no limit'
+        ),
+    ),
+    cfg.IntOpt(
+        'ttl',
+        default=3600,
+        min=0,
+        help=(
+            'number of seconds that cached projects, users and roles are '
+            'used before they are fetched again; 0 means no expiry'
+        ),
+    ),
+    cfg.BoolOpt(
+        'persistent',
+        default=False,
+        help=(
+            'keep cached projects, users, roles and role assignments in '
+            'an sqlite file so that they are reused by later commands'
+        ),
+    ),
+    cfg.StrOpt(
+        'path',
+        default='~/.nectar-osc-cache.sqlite',
+        help='pathname of the persistent identity cache',
+    ),
 ]
 
 
 cfg.CONF.register_opts(freshdesk_opts, group='freshdesk')
 cfg.CONF.register_opts(mailout_opts, group='mailout')
 cfg.CONF.register_opts(nova_opts, group='nova')
+cfg.CONF.register_opts(cache_opts, group='cache')
 
 
 def list_opts():
@@ -58,6 +203,7 @@ def list_opts():
         ('freshdesk', freshdesk_opts),
         ('mailout', mailout_opts),
         ('nova', nova_opts),
+        ('cache', cache_opts),
     ]
 
 
@@ -11,43 +11,179 @@
 #   under the License.
 #
 
+import collections
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import itertools
+import json
+import os
+import uuid
+
 from keystoneclient.exceptions import NotFound
+from oslo_config import cfg
+
+from nectar_osc.cache import Cache
+from nectar_osc.cache import use_cloud
+
+
+CONF = cfg.CONF
 
 # global session cache for project, role and user query data
-project_cache = {}
-user_cache = {}
-role_cache = {}
+project_cache = Cache('project', persistent=True)
+user_cache = Cache('user', persistent=True)
+role_cache = Cache('role', persistent=True)
+# role assignments by project id, as {role id: [user id, ...]}
+assignment_cache = Cache('assignment', persistent=True)
+
+# cached marker for names and ids that are known not to exist
+_NOT_FOUND = object()
+
+
+def cache_stats():
+    "Return the hit and miss statistics for the identity caches"
+    return [
+        c.stats()
+        for c in (project_cache, user_cache, role_cache, assignment_cache)
+    ]
 
 
 def get_role(identity, role_name):
     """Fetch project via the cache"""
-    if role_name in role_cache:
-        return role_cache[role_name]
-    else:
+    use_cloud(identity)
+    role = role_cache.get(role_name)
+    if role is None:
         role = identity.roles.find(name=role_name)
         role_cache[role_name] = role
-        return role
+    return role
 
 
 def get_user_emails_with_roles(
     identity, project_id, role_names, exclude_disabled=False
 ):
     """Get email addresses for users with certain roles
-    in a given project."""
-    emails = []
-    for role_name in role_names:
-        role = get_role(identity, role_name)
+    in a given project.
+
+    The project's role assignments are fetched with a single request, and
+    cached, and the users are resolved via the cache.  The emails are
+    ordered by role, following the order of 'role_names'.  The effective
+    assignments are used, so group memberships are expanded as in a
+    RecipientIndex.
+    """
+    use_cloud(identity)
+    role_ids = [get_role(identity, n).id for n in role_names]
+    assignments = assignment_cache.get(project_id) or {}
+    # The cache only holds the roles asked for so far
+    if any(role_id not in assignments for role_id in role_ids):
+        fetched = {role_id: [] for role_id in role_ids}
         ras = identity.role_assignments.list(
-            project=project_id, role=role, include_names=True
+            project=project_id, effective=True, include_names=True
         )
         for ra in ras:
-            u = get_user(identity, ra.user['id'], use_cache=False)
-            if exclude_disabled and not u.enabled:
-                continue
-            email = getattr(u, 'email', None)
-            if email and email not in emails:
-                emails.append(email)
-    return emails
+            user = getattr(ra, 'user', None)
+            if user and ra.role['id'] in fetched:
+                fetched[ra.role['id']].append(user['id'])
+        assignments = {**assignments, **fetched}
+        assignment_cache[project_id] = assignments
+    user_ids = itertools.chain(*(assignments[r] for r in role_ids))
+    emails = {}
+    for user_id in dict.fromkeys(user_ids):
+        u = get_user(identity, user_id, use_cache=True)
+        if exclude_disabled and not u.enabled:
+            continue
+        email = getattr(u, 'email', None)
+        if email:
+            emails.setdefault(email)
+    return list(emails)
+
+
+class RecipientIndex:
+    """Index of the recipient emails for every project in the cloud
+
+    The index is built from one (paged) listing of the effective
+    assignments for each role, so group memberships are expanded, and
+    one listing of all users.  Recipient lookups for a large mailout are
+    then made without any further Keystone requests.  The emails for a
+    project are ordered by role, following the order of 'role_names'.
+    Every project is indexed, with no emails if it has no recipients, so
+    that get() can tell those apart from projects created since the
+    index was built.
+    """
+
+    def __init__(self, role_names, path=None):
+        self.role_names = list(role_names)
+        self.path = path
+        self.timestamp = None
+        self.projects = {}
+
+    def __len__(self):
+        return len(self.projects)
+
+    def get(self, project_id):
+        "Return the emails for a project, or None if it isn't indexed"
+        return self.projects.get(project_id)
+
+    def build(self, identity):
+        "Build the index from the assignments.  Returns the project count"
+
+        user_ids = collections.defaultdict(
+            lambda: {name: [] for name in self.role_names}
+        )
+        for role_name in self.role_names:
+            role = get_role(identity, role_name)
+            ras = identity.role_assignments.list(
+                role=role, effective=True, include_names=True
+            )
+            for ra in ras:
+                project = ra.scope.get('project')
+                user = getattr(ra, 'user', None)
+                if project and user:
+                    user_ids[project['id']][role_name].append(user['id'])
+        users = {user.id: user for user in identity.users.list()}
+        self.projects = {
+            project.id: [] for project in identity.projects.list()
+        }
+        for project_id, by_role in user_ids.items():
+            emails = {}
+            for user_id in itertools.chain(*by_role.values()):
+                u = users.get(user_id) or get_user(
+                    identity, user_id, use_cache=True
+                )
+                email = getattr(u, 'email', None)
+                if email:
+                    emails.setdefault(email)
+            self.projects[project_id] = list(emails)
+        self.timestamp = datetime.now(timezone.utc)
+        return len(self.projects)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        # An index built for other roles can't be reused
+        if data['roles'] == self.role_names:
+            self.timestamp = datetime.fromisoformat(data['timestamp'])
+            self.projects = data['projects']
+
+    def save(self):
+        data = {
+            'timestamp': self.timestamp.isoformat(),
+            'roles': self.role_names,
+            'projects': self.projects,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def is_stale(self, now=None):
+        if self.timestamp is None:
+            return True
+        now = now or datetime.now(timezone.utc)
+        ttl = timedelta(hours=CONF.mailout.recipient_index_ttl)
+        return now - self.timestamp > ttl
 
 
 def get_tenant_managers_emails(identity, instance):
@@ -58,39 +194,81 @@ def get_tenant_managers_emails(identity, instance):
     )
 
 
+def prefetch(identity):
+    """Populate the project and user caches with bulk listings
+
+    This replaces the per-server project and user lookups in a large
+    mailout with a couple of list requests.  Returns the number of
+    projects and users that were cached.
+    """
+    use_cloud(identity)
+    projects = 0
+    for project in identity.projects.list():
+        project_cache[project.id] = project
+        projects += 1
+    users = 0
+    for user in identity.users.list():
+        user_cache[user.id] = user
+        users += 1
+    return (projects, users)
+
+
 def get_project(identity, name_or_id, use_cache=False):
     """Fetch project, optionally via the cache"""
-    if use_cache and name_or_id in project_cache:
-        project = project_cache[name_or_id]
-    else:
-        try:
-            project = None
-            project = identity.projects.get(name_or_id)
-        except NotFound:
-            project = identity.projects.find(name=name_or_id)
-        finally:
-            if project:
-                project_cache.update({project.id: project})
-            else:
-                # TODO(SC) bad idea ...
-                print(f"Unknown Project {name_or_id}")
-    return project
+    use_cloud(identity)
+    return _get_or_find(
+        identity.projects, project_cache, 'Project', name_or_id, use_cache
+    )
 
 
 def get_user(identity, name_or_id, use_cache=False):
     """Fetch user, optionally via the cache"""
-    if use_cache and name_or_id in user_cache:
-        user = user_cache[name_or_id]
-    else:
+    use_cloud(identity)
+    return _get_or_find(
+        identity.users, user_cache, 'User', name_or_id, use_cache
+    )
+
+
+def _looks_like_id(value):
+    try:
+        uuid.UUID(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def _get_or_find(manager, cache, kind, name_or_id, use_cache):
+    """Fetch a project or user by id or name
+
+    Values that look like ids are tried with 'get' before 'find', and
+    the other way round for names, so a lookup usually costs a single
+    request.  Results are cached by id and by the name or id that was
+    asked for.  A NotFound is cached too, and raised again by cached
+    lookups until the entry expires.
+    """
+    if use_cache:
+        entity = cache.get(name_or_id)
+        if entity is _NOT_FOUND:
+            raise NotFound(f"{kind} {name_or_id} not found")
+        if entity is not None:
+            return entity
+    lookups = [
+        lambda: manager.get(name_or_id),
+        lambda: manager.find(name=name_or_id),
+    ]
+    if not _looks_like_id(name_or_id):
+        lookups.reverse()
+    try:
         try:
-            user = None
-            user = identity.users.get(name_or_id)
+            entity = lookups[0]()
         except NotFound:
-            user = identity.users.find(name=name_or_id)
-        finally:
-            if user:
-                user_cache.update({user.id: user})
-            else:
-                # TODO(SC) bad idea ...
-                print(f"Unknown User {name_or_id}")
-    return user
+            entity = lookups[1]()
+    except NotFound:
+        cache[name_or_id] = _NOT_FOUND
+        # TODO(SC) bad idea ...
+        print(f"Unknown {kind} {name_or_id}")
+        raise
+    cache[entity.id] = entity
+    if name_or_id != entity.id:
+        cache[name_or_id] = entity
+    return entity
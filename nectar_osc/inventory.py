@@ -0,0 +1,134 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import json
+import os
+
+from oslo_config import cfg
+
+from nectar_osc.compute import extract_server_info
+from nectar_osc.compute import InstanceExtractor
+from nectar_osc.compute import InstanceRecord
+from nectar_osc.util import cloud_url
+
+
+CONF = cfg.CONF
+
+# Allow for clock skew between us and Nova when asking for changes
+CHANGES_SINCE_MARGIN = timedelta(minutes=5)
+
+
+class Inventory:
+    """On-disk snapshot of the extracted information for all instances
+
+    The first refresh lists every instance in the cloud.  Subsequent
+    refreshes (within the TTL) only ask Nova for the instances that
+    have changed since the previous refresh.  The snapshot records the
+    cloud it was taken from, and a refresh against another cloud starts
+    again from scratch.
+
+    The records are not resolved, as project names and emails would go
+    stale and an orphaned instance would break the refresh, so their
+    project names and user details are None.  See resolve_identity.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.timestamp = None
+        self.cloud = None
+        self.records = {}
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, id):
+        return self.records.get(id)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.timestamp = datetime.fromisoformat(data['timestamp'])
+        self.cloud = data.get('cloud')
+        self.records = {
+            r['id']: InstanceRecord(**r) for r in data['instances']
+        }
+
+    def save(self):
+        data = {
+            'timestamp': self.timestamp.isoformat(),
+            'cloud': self.cloud,
+            'instances': [dict(r) for r in self.records.values()],
+        }
+        # Write and rename so that an interrupted save can't leave a
+        # truncated snapshot behind.
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def is_stale(self, now=None):
+        if self.timestamp is None:
+            return True
+        now = now or datetime.now(timezone.utc)
+        ttl = timedelta(hours=CONF.mailout.inventory_ttl)
+        return now - self.timestamp > ttl
+
+    def refresh(self, clients, force=False, **kwargs):
+        """Bring the snapshot up to date and save it
+
+        A full listing is done when 'force' is set, the snapshot is
+        older than the TTL or it was taken from another cloud.
+        Otherwise only the changes are fetched.  Any other keyword
+        arguments are passed to the InstanceExtractor.  Returns the
+        number of records added, updated or removed.
+        """
+
+        now = datetime.now(timezone.utc)
+        cloud = cloud_url(clients.identity)
+        if force or self.is_stale(now) or cloud != self.cloud:
+            extractor = InstanceExtractor(
+                clients, defer_identity=True, **kwargs
+            )
+            self.records = {r.id: r for r in extractor.iter()}
+            changes = len(self.records)
+        else:
+            extractor = InstanceExtractor(
+                clients,
+                changes_since=(
+                    self.timestamp - CHANGES_SINCE_MARGIN
+                ).isoformat(),
+                **kwargs,
+            )
+            changes = 0
+            for server in extractor.servers():
+                # Deleted instances are included in the changes
+                if server.status == 'DELETED':
+                    self.records.pop(server.id, None)
+                else:
+                    self.records[server.id] = extract_server_info(
+                        clients, server=server, resolve=False
+                    )
+                changes += 1
+        self.timestamp = now
+        self.cloud = cloud
+        self.save()
+        return changes
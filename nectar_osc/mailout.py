@@ -11,8 +11,11 @@
 #   under the License.
 #
 
+from concurrent import futures
 from datetime import datetime
 from datetime import timedelta
+import hashlib
+import json
 import logging
 import os
 import shutil
@@ -30,17 +33,42 @@ from openstack.exceptions import NotFoundException
 from osc_lib.command import command
 from oslo_config import cfg
 
-from nectar_osc.compute import all_instances
 from nectar_osc.compute import extract_server_info
+from nectar_osc.compute import InstanceRecord
+from nectar_osc.compute import iter_instances
+from nectar_osc.compute import ListingCheckpoint
+from nectar_osc.compute import resolve_identity
+from nectar_osc.identity import cache_stats
 from nectar_osc.identity import get_project
 from nectar_osc.identity import get_user
 from nectar_osc.identity import get_user_emails_with_roles
+from nectar_osc.identity import prefetch
+from nectar_osc.identity import RecipientIndex
+from nectar_osc.inventory import Inventory
+from nectar_osc.notifications import dump_yaml
+from nectar_osc.notifications import find_journals
+from nectar_osc.notifications import journal_filename
+from nectar_osc.notifications import NotificationStore
+from nectar_osc.notifications import open_notifications
+from nectar_osc.notifications import SendJournal
+from nectar_osc.notifications import SendLock
+from nectar_osc.notifications import STORE_FILENAME
+from nectar_osc.util import IPMatcher
 from nectar_osc.util import normalize_filename
 from nectar_osc.util import query_yes_no
+from nectar_osc.util import TokenBucket
 
 
 CONF = cfg.CONF
 
+# Roles whose users are sent project notifications, in recipient order
+RECIPIENT_ROLES = ['TenantManager', 'Member']
+
+# Dump instance records in the notification context as plain mappings
+yaml.add_representer(
+    InstanceRecord, lambda dumper, data: dumper.represent_dict(data)
+)
+
 
 class MailoutPrepCommand(command.Command):
     """mailout top class"""
@@ -75,8 +103,8 @@ class MailoutPrepCommand(command.Command):
             '--ip',
             action='append',
             help=(
-                'Only consider instances with specific ip address: '
-                'this option can be repeated'
+                'Only consider instances with specific ip address or in a '
+                'CIDR range: this option can be repeated'
             ),
         )
         parser.add_argument(
@@ -135,6 +163,90 @@ class MailoutPrepCommand(command.Command):
             ),
         )
         parser.add_argument('--limit', help='Limit the number of instances')
+        parser.add_argument(
+            '--list-workers',
+            type=int,
+            default=CONF.nova.list_workers,
+            help=(
+                'Number of Nova listings to run concurrently when '
+                '--node, --zone or --ip is repeated'
+            ),
+        )
+        parser.add_argument(
+            '--extract-workers',
+            type=int,
+            default=CONF.mailout.extract_workers,
+            help=(
+                'Number of instances whose project and user details are '
+                'looked up concurrently.  This also sets the number of '
+                '--instances-file instances fetched concurrently'
+            ),
+        )
+        parser.add_argument(
+            '--render-workers',
+            type=int,
+            default=CONF.mailout.render_workers,
+            help='Number of processes that render notifications concurrently',
+        )
+        parser.add_argument(
+            '--store',
+            action='store_true',
+            help=(
+                'Save the notifications in a single indexed file rather '
+                "than one file per notification.  Use 'mailout export' to "
+                'write them out as files'
+            ),
+        )
+        parser.add_argument(
+            '--prefetch-identity',
+            action='store_true',
+            help=(
+                'List all projects and users up front rather than looking '
+                'them up one instance at a time.  This is faster for large '
+                'mailouts'
+            ),
+        )
+        parser.add_argument(
+            '--inventory',
+            action='store_true',
+            help=(
+                'Select instances from the inventory snapshot in the work '
+                'directory, refreshing it with the changes since it was '
+                'last used'
+            ),
+        )
+        parser.add_argument(
+            '--refresh-inventory',
+            action='store_true',
+            help='Rebuild the inventory snapshot from scratch',
+        )
+        parser.add_argument(
+            '--recipient-index',
+            action='store_true',
+            help=(
+                'Look up the recipients for every project in the cloud up '
+                'front, and save them in the work directory for reuse.  '
+                'This is faster for mailouts affecting many projects'
+            ),
+        )
+        parser.add_argument(
+            '--defer-identity',
+            action='store_true',
+            help=(
+                'Only look up project names and user details for the '
+                'projects that will be notified, once the instances have '
+                'been grouped by project'
+            ),
+        )
+        parser.add_argument(
+            '--checkpoint',
+            action='store_true',
+            help=(
+                'Save the progress of the instance listing in the work '
+                'directory, and resume an interrupted listing with the '
+                'same criteria'
+            ),
+        )
 
         return parser
 
@@ -194,6 +306,19 @@ class MailoutPrepCommand(command.Command):
         else:
             self.limit = None
 
+        if args.ip:
+            try:
+                IPMatcher(args.ip)
+            except ValueError as e:
+                raise Exception(f"Invalid --ip: {e}")
+
+        if args.list_workers < 1:
+            raise Exception("Invalid --list-workers: must be >= 1")
+        if args.extract_workers < 1:
+            raise Exception("Invalid --extract-workers: must be >= 1")
+        if args.render_workers < 1:
+            raise Exception("Invalid --render-workers: must be >= 1")
+
         if not args.template:
             raise Exception("No template argument provided")
 
@@ -212,14 +337,30 @@ class MailoutPrepCommand(command.Command):
         self.image = args.image
         self.status = args.status
         identity = self.clients.identity
-        self.user_id = get_user(identity, args.user).id if args.user else None
+        self.user_id = (
+            get_user(identity, args.user, use_cache=True).id
+            if args.user
+            else None
+        )
         self.project_id = (
-            get_project(identity, args.project).id if args.project else None
+            get_project(identity, args.project, use_cache=True).id
+            if args.project
+            else None
         )
         self.subject = args.subject or self.default_subject
         self.instances_file = args.instances_file
         self.record_metadata = args.record_metadata
         self.metadata_field = args.metadata_field
+        self.list_workers = args.list_workers
+        self.extract_workers = args.extract_workers
+        self.render_workers = args.render_workers
+        self.use_store = args.store
+        self.prefetch_identity = args.prefetch_identity
+        self.use_inventory = args.inventory or args.refresh_inventory
+        self.refresh_inventory = args.refresh_inventory
+        self.use_checkpoint = args.checkpoint
+        self.use_recipient_index = args.recipient_index
+        self.defer_identity = args.defer_identity
 
     def setup(self, args):
         self.clients = self.app.client_manager
@@ -230,6 +371,46 @@ class MailoutPrepCommand(command.Command):
         self.mailout_dir = tempfile.mkdtemp(dir=self.work_dir)
         print(f"Mailout will be prepared in directory {self.mailout_dir}")
         self.count = 0
+        if self.use_store:
+            self.store = NotificationStore(
+                os.path.join(self.mailout_dir, STORE_FILENAME)
+            )
+        else:
+            self.store = None
+        if self.prefetch_identity:
+            (projects, users) = prefetch(self.clients.identity)
+            print(f"Prefetched {projects} projects and {users} users")
+        if self.use_inventory:
+            self.inventory = Inventory(
+                os.path.join(self.work_dir, 'inventory.json')
+            )
+            self.inventory.load()
+            changes = self.inventory.refresh(
+                self.clients,
+                force=self.refresh_inventory,
+                workers=self.list_workers,
+                extract_workers=self.extract_workers,
+            )
+            print(
+                f"Inventory of {len(self.inventory)} instances refreshed "
+                f"with {changes} changes"
+            )
+        else:
+            self.inventory = None
+        if self.use_recipient_index:
+            self.recipient_index = RecipientIndex(
+                RECIPIENT_ROLES,
+                path=os.path.join(self.work_dir, 'recipients.json'),
+            )
+            self.recipient_index.load()
+            if self.recipient_index.is_stale():
+                self.recipient_index.build(self.clients.identity)
+                self.recipient_index.save()
+            print(
+                f"Recipient index covers {len(self.recipient_index)} projects"
+            )
+        else:
+            self.recipient_index = None
 
     def read_ids(self, filename):
         "Return an id iterator for file containing a list of ids"
@@ -245,24 +426,72 @@ class MailoutPrepCommand(command.Command):
         the context data uses for generation and a key and sequence no.
         """
 
-        body = self.generator.render_template(context)
-        subject = self.generator.render_subject(context)
+        (filepath, content) = self.prepare_notification(
+            key, recipients, context
+        )
+        if self.store is not None:
+            self.store.add(render_notification(self.generator, content))
+        else:
+            dump_notification(self.generator, filepath, content)
+
+    def generate_notifications(self, notifications):
+        """Generate notifications from (key, recipients, context) tuples
+
+        With more than one render worker the notifications are rendered
+        and dumped by a pool of processes.  The sequence numbers are
+        still assigned here, in order.
+        """
+
+        if self.render_workers <= 1:
+            for notification in notifications:
+                self.generate_notification(*notification)
+        else:
+            self._generate_in_pool(notifications)
+        if self.store is not None:
+            self.store.commit()
+
+    def _generate_in_pool(self, notifications):
+        pool = futures.ProcessPoolExecutor(
+            max_workers=self.render_workers,
+            initializer=_init_render_worker,
+            initargs=(self.template, self.subject),
+        )
+        try:
+            jobs = []
+            for notification in notifications:
+                (filepath, content) = self.prepare_notification(*notification)
+                if self.store is not None:
+                    job = pool.submit(render_notification, None, content)
+                else:
+                    job = pool.submit(
+                        dump_notification, None, filepath, content
+                    )
+                jobs.append(job)
+            for job in jobs:
+                content = job.result()
+                if self.store is not None:
+                    self.store.add(content)
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def prepare_notification(self, key, recipients, context):
+        """Assign the next sequence no and the file for a notification
+
+        Returns the file pathname and the notification content, less
+        the rendered subject and body.
+        """
+
         filename = normalize_filename(f"notification@{key}")
         filepath = os.path.join(self.mailout_dir, filename)
-        if os.path.exists(filepath):
-            raise Exception(f"Notification file {filename} already exists!")
-        with open(filepath, 'w') as dump:
-            content = {
-                'SeqNo': self.count,
-                'Key': key,
-                'Subject': subject,
-                'Body': body,
-                'SendTo': recipients,
-                'Context': dict(context),
-            }
-            yaml.dump(content, dump, default_flow_style=False)
-
+        self.generator.refine_context(context)
+        content = {
+            'SeqNo': self.count,
+            'Key': key,
+            'SendTo': recipients,
+            'Context': dict(context),
+        }
         self.count += 1
+        return (filepath, content)
 
 
 class Instances(MailoutPrepCommand):
@@ -288,10 +517,23 @@ class Instances(MailoutPrepCommand):
         # TODO(SC) refactor as other subcommands are implemented
         self.log.debug('take_action(%s)', args)
         self.setup(args)
+        checkpoint = None
         if self.instances_file:
             instances = self.load_instances()
         else:
-            instances = all_instances(
+            if self.use_checkpoint and self.inventory is None:
+                checkpoint = ListingCheckpoint(self.checkpoint_path())
+                if not os.path.exists(checkpoint.path):
+                    pass
+                elif checkpoint.is_stale():
+                    print(f"Discarding stale checkpoint {checkpoint.path}")
+                    checkpoint.remove()
+                else:
+                    print(
+                        "Resuming instance listing from checkpoint "
+                        f"{checkpoint.path}"
+                    )
+            instances = iter_instances(
                 self.clients,
                 zones=self.zones,
                 hosts=self.nodes,
@@ -301,15 +543,37 @@ class Instances(MailoutPrepCommand):
                 limit=self.limit,
                 user_id=self.user_id,
                 project_id=self.project_id,
+                workers=self.list_workers,
+                extract_workers=self.extract_workers,
+                inventory=self.inventory,
+                checkpoint=checkpoint,
+                defer_identity=self.defer_identity,
             )
-        self.projects = self.populate_data(instances)
 
+        # The instances are streamed, so the 'instances.list' file is
+        # written as they are collated.
         print(f"Saving 'instances.list' file in {self.mailout_dir}")
         with open(os.path.join(self.mailout_dir, 'instances.list'), 'w') as f:
-            for instance in instances:
-                f.write(f"{instance['id']}\n")
+            self.projects = self.populate_data(self.save_ids(instances, f))
 
         print(f"Will generate {len(self.projects)} notifications")
+        self.generate_notifications(self.notifications())
+        print(f"Generated {self.count} notifications into {self.mailout_dir}")
+        if self.store is not None:
+            self.store.close()
+        if checkpoint:
+            checkpoint.remove()
+        for stats in cache_stats():
+            self.log.info(
+                "%(name)s cache: %(size)d entries, %(hits)d hits, "
+                "%(misses)d misses, %(evictions)d evictions, "
+                "%(loads)d loaded from disk",
+                stats,
+            )
+
+    def notifications(self):
+        "Generate the (key, recipients, context) for each project"
+
         for project_name, project_data in self.projects.items():
             context = {
                 'project_name': project_name,
@@ -325,43 +589,133 @@ class Instances(MailoutPrepCommand):
                 context['zones'] = self.zones
 
             context.update(project_data.items())
-            self.generate_notification(
-                project_name, project_data['recipients'], context
-            )
-        print(f"Generated {self.count} notifications into {self.mailout_dir}")
+            yield (project_name, project_data['recipients'], context)
+
+    def checkpoint_path(self):
+        "Return the listing checkpoint pathname for the search criteria"
+
+        criteria = json.dumps(
+            [
+                self.zones,
+                self.nodes,
+                self.image,
+                self.ips,
+                self.status,
+                self.limit,
+                self.user_id,
+                self.project_id,
+            ]
+        )
+        digest = hashlib.sha1(criteria.encode()).hexdigest()[:12]
+        return os.path.join(self.work_dir, f'listing-{digest}.checkpoint')
+
+    def save_ids(self, instances, f):
+        "Write the instance ids to 'f' as the instances are generated"
+
+        for instance in instances:
+            f.write(f"{instance['id']}\n")
+            yield instance
 
     def load_instances(self):
+        """Generate the instances listed in the instances file
+
+        The instances are produced in file order, with duplicates
+        dropped.  With more than one extract worker, the instances are
+        fetched and extracted concurrently.
+        """
+
         # TODO(SC) refactor as other subcommands are implemented
-        ids = self.read_ids(self.instances_file)
-        res = []
-        for id in set(ids):
+        ids = list(dict.fromkeys(self.read_ids(self.instances_file)))
+        ids = [id for id in ids if id]
+        if self.extract_workers > 1:
+            pool = futures.ThreadPoolExecutor(max_workers=self.extract_workers)
             try:
-                server = self.clients.compute.get_server(id)
-            except NotFoundException:
-                print(f"Instance '{id}' not found: skipping it.")
-                continue
-            res.append(extract_server_info(self.clients, server=server))
-        return res
+                records = pool.map(self.load_instance, ids)
+                yield from (r for r in records if r is not None)
+            finally:
+                pool.shutdown(wait=False, cancel_futures=True)
+        else:
+            for id in ids:
+                record = self.load_instance(id)
+                if record is not None:
+                    yield record
+
+    def load_instance(self, id):
+        "Return the info for instance 'id' or None if it doesn't exist"
+
+        if self.inventory is not None:
+            record = self.inventory.get(id)
+            if record is not None:
+                return record
+        try:
+            server = self.clients.compute.get_server(id)
+        except NotFoundException:
+            print(f"Instance '{id}' not found: skipping it.")
+            return None
+        return extract_server_info(
+            self.clients, server=server, resolve=not self.defer_identity
+        )
+
+    def get_recipients(self, project_id):
+        "Return the recipient emails for a project"
+
+        if self.recipient_index is not None:
+            emails = self.recipient_index.get(project_id)
+            # Projects created since the index was built are looked up
+            if emails is not None:
+                return emails
+        return get_user_emails_with_roles(
+            self.clients.identity, project_id, RECIPIENT_ROLES
+        )
 
     def populate_data(self, instances):
         # TODO(SC) refactor as other subcommands are implemented
+        if self.defer_identity:
+            return self.populate_deferred_data(instances)
         projects = {}
-        identity = self.clients.identity
         for inst in instances:
+            # e.g. a record checkpointed by a run with --defer-identity
+            if inst['project_name'] is None:
+                resolve_identity(self.clients, inst)
             key = inst['project_name']
-            if key in projects.keys():
-                projects[key]['instances'].append(dict(inst))
+            if key in projects:
+                projects[key]['instances'].append(inst)
             else:
-                cclist = get_user_emails_with_roles(
-                    identity, inst['project'], ['TenantManager', 'Member']
-                )
+                cclist = self.get_recipients(inst['project'])
                 # Exclude projects with no valid recipients; e.g. tempest
                 if cclist:
-                    projects[key] = {'instances': [dict(inst)]}
+                    projects[key] = {'instances': [inst]}
                     projects[key].update({'recipients': cclist})
 
         return projects
 
+    def populate_deferred_data(self, instances):
+        """Group the instances by project id before resolving identities
+
+        The project and user details are only looked up for the
+        projects that have recipients.
+        """
+
+        groups = {}
+        for inst in instances:
+            groups.setdefault(inst['project'], []).append(inst)
+        projects = {}
+        for project_id, insts in groups.items():
+            cclist = self.get_recipients(project_id)
+            # Exclude projects with no valid recipients; e.g. tempest
+            if not cclist:
+                continue
+            for inst in insts:
+                if inst['project_name'] is None:
+                    resolve_identity(self.clients, inst)
+            key = insts[0]['project_name']
+            # Projects in different domains can have the same name
+            if key in projects:
+                projects[key]['instances'].extend(insts)
+            else:
+                projects[key] = {'instances': insts, 'recipients': cclist}
+        return projects
+
 
 # class Volumes(MailoutPrepCommand):
 #     """Prepare volume mailout
@@ -459,10 +813,18 @@ class Cleanup(command.Command):
 class Send(command.Command):
     """Perform a previously prepared mailout.
 
-    We keep track of where we got to in the mailout by recording message
-    sequence numbers in the LAST_SENT file in the mailout directory.  This
-    also allows us send notifications in batches (using --limit) or do a
-    trial send (using --send-to).
+    We keep track of where we got to in the mailout by appending the
+    sequence numbers of sent messages to the SENT.journal file in the
+    mailout directory.  This also allows us send notifications in batches
+    (using --limit) or do a trial send (using --send-to).  Since the
+    journal records each notification, sends can complete out of order
+    (using --concurrency) and still be resumed exactly.  A LAST_SENT file
+    written by older versions is still honoured.
+
+    A mailout can be split between processes or machines that share the
+    mailout directory with --shard.  Each shard has its own journal, and
+    locks stop two processes sending the same notifications, whether
+    with the same shard, shards of different counts or no shard.
     """
 
     log = logging.getLogger(__name__ + '.Mailout.Send')
@@ -477,8 +839,7 @@ class Send(command.Command):
             '--send-to',
             help=(
                 'Redirect notifications to this user.  This has the '
-                'side-effect of suppressing updates to the LAST_SENT '
-                'file.'
+                'side-effect of suppressing updates to the send journal.'
             ),
         )
         parser.add_argument(
@@ -490,7 +851,8 @@ class Send(command.Command):
             default=False,
             help=(
                 'Resume sending notifications after a failure.  '
-                'The resumption point is determined by the LAST_SENT file'
+                'The notifications that have been sent are determined by '
+                'the send journal'
             ),
         )
         parser.add_argument(
@@ -499,6 +861,26 @@ class Send(command.Command):
             default=False,
             help=('Send without asking for confirmation'),
         )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=1,
+            help='Number of notifications to send concurrently',
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            help='Limit the sending rate to this many notifications a second',
+        )
+        parser.add_argument(
+            '--shard',
+            metavar='<index>/<count>',
+            help=(
+                'Only send the notifications whose sequence no modulo '
+                '<count> is <index>, so that <count> processes can share '
+                'the mailout'
+            ),
+        )
         return parser
 
     def check_args(self, args):
@@ -518,38 +900,83 @@ class Send(command.Command):
                 raise Exception("Invalid --limit: an integer is required")
         else:
             self.limit = None
+        if args.concurrency < 1:
+            raise Exception("Invalid --concurrency: must be >= 1")
+        if args.rate is not None and args.rate <= 0:
+            raise Exception("Invalid --rate: must be > 0")
         self.resume = args.resume
         self.confirm = args.confirm
         self.send_to = args.send_to
+        self.concurrency = args.concurrency
+        self.bucket = TokenBucket(args.rate) if args.rate else None
+        if args.shard:
+            try:
+                (index, count) = (int(n) for n in args.shard.split('/'))
+            except ValueError:
+                raise Exception("Invalid --shard: <index>/<count> is required")
+            if count < 1 or not 0 <= index < count:
+                raise Exception(
+                    "Invalid --shard: <index> must be from 0 to <count> - 1"
+                )
+            self.shard = (index, count)
+        else:
+            self.shard = None
+
+    def in_shard(self, seqno):
+        return self.shard is None or seqno % self.shard[1] == self.shard[0]
 
     def take_action(self, args):
         self.check_args(args)
         self.clients = self.app.client_manager
         self.taynac = self.clients.taynac
         self.last_sent_pathname = os.path.join(self.mailout_dir, "LAST_SENT")
+        self.journal = SendJournal(
+            os.path.join(self.mailout_dir, journal_filename(self.shard))
+        )
+        self.send_lock = SendLock(self.mailout_dir, self.shard)
+        # A trial send doesn't record anything, so it needs no locks
+        if not self.send_to:
+            self.send_lock.acquire()
+            if not self.journal.acquire():
+                self.send_lock.release()
+                shard = f"shard {args.shard}" if self.shard else "mailout"
+                raise Exception(
+                    f"Another process is already sending this {shard}"
+                )
         self.log.debug('take_action(%s)', args)
-        (notifications, last_sent) = self.load_notifications()
-        if last_sent is None:
-            first = 0
-        elif last_sent >= len(notifications) - 1:
-            raise Exception(
-                "These notifications have already been sent. "
-                f"Remove file {self.last_sent_pathname} and rerun "
-                "to force resending."
-            )
-        else:
-            first = last_sent + 1
+        try:
+            (notifications, sent) = self.load_notifications()
+            try:
+                self.send_notifications(notifications, sent)
+            finally:
+                notifications.close()
+        finally:
+            self.journal.close()
+            self.send_lock.release()
+
+    def send_notifications(self, notifications, sent):
+        sent = {i for i in sent if self.in_shard(i)}
+        pending = [
+            i for i in notifications if i not in sent and self.in_shard(i)
+        ]
+        if sent:
+            progress = ' and '.join(self.progress_files)
+            if not pending:
+                raise Exception(
+                    "These notifications have already been sent. "
+                    f"Remove {progress} and rerun to force resending."
+                )
             if self.resume:
-                print(f"Resuming notifications at sequence no {first}")
+                print(f"Resuming notifications at sequence no {pending[0]}")
             else:
                 raise Exception(
                     "It appears that some of the notifications have "
-                    "been sent already.  Rerun with '--resume' to continue "
-                    f"sending at sequence no {first}.  Remove file "
-                    f"{self.last_sent_pathname} and rerun to force "
+                    "been sent already.  Rerun with '--resume' to send "
+                    f"the {len(pending)} that have not been sent.  "
+                    f"Remove {progress} and rerun to force "
                     "resending of all notifications."
                 )
-        nos_to_send = len(notifications) - first
+        nos_to_send = len(pending)
         if self.send_to:
             print(
                 f"Redirecting all {nos_to_send} notifications "
@@ -557,38 +984,101 @@ class Send(command.Command):
             )
         else:
             if not self.confirm:
+                recipients = sum(
+                    notifications.recipient_count(i) for i in pending
+                )
                 print(
                     f"CAUTION: this will send {nos_to_send} notifications "
-                    "with each one potentially going to multiple users."
+                    f"with {recipients} recipients in all."
                 )
                 if not query_yes_no(
                     "Do you want to send them now?", default='no'
                 ):
                     sys.exit(1)
 
-        print(f"Sending notifications starting at sequence no {first}")
+        if pending:
+            print(
+                f"Sending notifications starting at sequence no {pending[0]}"
+            )
+
+        if self.limit:
+            pending = pending[: self.limit]
+        self.sent = 0
+        self.users = 0
+        try:
+            if self.concurrency > 1:
+                self.send_concurrently(notifications, pending)
+            else:
+                for i in pending:
+                    notification = notifications[i]
+                    self.record_sent(
+                        i, notification, self.send(i, notification)
+                    )
+        finally:
+            print(
+                f"Sent {self.sent} notifications affecting {self.users} users"
+            )
+
+    def send_concurrently(self, notifications, seqnos):
+        """Send notifications from a pool of threads
 
-        sent = 0
-        users = 0
+        The notifications are loaded here, as the store can only be
+        used from this thread.  A bounded number of sends are queued so
+        that sending stops soon after a failure.  The first failure is
+        raised once the sends in progress have finished.
+        """
+
+        pool = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        pending = {}
+        todo = iter(seqnos)
+        error = None
         try:
-            for i in range(first, len(notifications)):
-                if self.limit and sent >= self.limit:
+            while True:
+                while error is None and len(pending) < self.concurrency * 2:
+                    i = next(todo, None)
+                    if i is None:
+                        break
+                    notification = notifications[i]
+                    job = pool.submit(self.send, i, notification)
+                    pending[job] = (i, notification)
+                if not pending:
                     break
-                if i not in notifications:
-                    continue  # This notification has been removed.  Skip.
-                notification = notifications[i]
-                try:
-                    self.send_notification(notification)
-                except Exception:
-                    print(
-                        "Failed while processing notification with "
-                        f"sequence no {i}"
-                    )
-                    raise
-                sent += 1
-                users += len(notification['SendTo'])
+                (done, _) = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED
+                )
+                for job in done:
+                    (i, notification) = pending.pop(job)
+                    try:
+                        self.record_sent(i, notification, job.result())
+                    except Exception as e:
+                        error = error or e
+            if error:
+                raise error
         finally:
-            print(f"Sent {sent} notifications affecting {users} users")
+            pool.shutdown(cancel_futures=True)
+
+    def send(self, seqno, notification):
+        "Send a notification, subject to the rate limit"
+
+        if self.bucket:
+            self.bucket.acquire()
+        try:
+            return self.send_notification(notification)
+        except Exception:
+            print(
+                f"Failed while processing notification with sequence no {seqno}"
+            )
+            raise
+
+    def record_sent(self, seqno, notification, response):
+        "Record that a notification has been sent in the journal"
+
+        self.sent += 1
+        self.users += len(notification['SendTo'])
+        # When using 'send_to', we are not sending "for real" so don't
+        # update the journal
+        if not self.send_to:
+            self.journal.record(seqno, _message_id(response))
 
     def send_notification(self, notification):
         if not notification['Subject']:
@@ -602,33 +1092,225 @@ class Send(command.Command):
             recipient = notification['SendTo'][0]
             cc = notification['SendTo'][1:]
 
-        self.taynac.messages.send(
+        return self.taynac.messages.send(
             subject=notification['Subject'],
             body=notification['Body'],
             recipient=recipient,
             cc=cc,
         )
-        # When using 'send_to', we are not sending "for real" so don't
-        # update the LAST_SENT file
-        if not self.send_to:
-            with open(self.last_sent_pathname, 'w') as last_sent:
-                last_sent.write(str(notification['SeqNo']))
 
     def load_notifications(self):
+        """Return the notifications and the set of SeqNos already sent
+
+        The SeqNos are merged from all of the send journals, so that a
+        mailout can be resumed with different shards.  A LAST_SENT file
+        means that every notification up to and including that SeqNo was
+        sent.
+        """
+
+        sent = set()
+        self.progress_files = []
+        for filename in find_journals(self.mailout_dir):
+            path = os.path.join(self.mailout_dir, filename)
+            sent.update(SendJournal(path).load())
+            self.progress_files.append(path)
         try:
             with open(self.last_sent_pathname) as last_file:
-                last_sent = int(last_file.readline())
+                sent.update(range(int(last_file.readline()) + 1))
+            self.progress_files.append(self.last_sent_pathname)
+        except FileNotFoundError:
+            pass
+
+        return (open_notifications(self.mailout_dir), sent)
+
+
+def _message_id(response):
+    "Return the id of the message that taynac created, if there is one"
+
+    message_id = getattr(response, 'id', None)
+    if message_id is None and isinstance(response, dict):
+        message_id = response.get('id')
+    return message_id if isinstance(message_id, (str, int)) else None
+
+
+class Status(command.Lister):
+    """Show the progress of sending a mailout
+
+    There is a row for each send journal, i.e. for each shard that has
+    been sent, and a total row.  Notifications are only counted as
+    pending if no journal records them as sent.
+    """
+
+    log = logging.getLogger(__name__ + '.Mailout.Status')
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument(
+            '--mailout-dir',
+            help='Directory where the mailout information was saved',
+        )
+        return parser
+
+    def check_args(self, args):
+        if not args.mailout_dir:
+            raise Exception("--mailout-dir <directory> option is required")
+        self.mailout_dir = args.mailout_dir
+        if not os.path.exists(self.mailout_dir):
+            raise Exception(
+                f"Mailout directory '{self.mailout_dir}' not found"
+            )
+
+    def take_action(self, args):
+        self.check_args(args)
+        self.log.debug('take_action(%s)', args)
+        notifications = open_notifications(self.mailout_dir)
+        try:
+            seqnos = list(notifications)
+        finally:
+            notifications.close()
+
+        journals = []
+        sent = set()
+        for filename, shard in find_journals(self.mailout_dir).items():
+            journal = SendJournal(os.path.join(self.mailout_dir, filename))
+            entries = journal.load()
+            sent.update(entries)
+            journals.append((filename, shard, journal, entries))
+        try:
+            with open(os.path.join(self.mailout_dir, 'LAST_SENT')) as f:
+                sent.update(range(int(f.readline()) + 1))
         except FileNotFoundError:
-            last_sent = None
+            pass
+
+        rows = []
+        for filename, shard, journal, entries in journals:
+            mine = [
+                i for i in seqnos if shard is None or i % shard[1] == shard[0]
+            ]
+            rows.append(
+                (
+                    filename,
+                    len(mine),
+                    len(entries),
+                    len([i for i in mine if i not in sent]),
+                    max((e['time'] for e in entries.values()), default=''),
+                    journal.is_active(),
+                )
+            )
+        pending = len([i for i in seqnos if i not in sent])
+        rows.append(
+            (
+                'total',
+                len(seqnos),
+                len(seqnos) - pending,
+                pending,
+                max((row[4] for row in rows), default=''),
+                any(row[5] for row in rows),
+            )
+        )
+        columns = (
+            'Journal',
+            'Notifications',
+            'Sent',
+            'Pending',
+            'Last Sent',
+            'Active',
+        )
+        return (columns, rows)
+
+
+class Export(command.Command):
+    """Write out the notifications in a mailout's store as files
+
+    Each notification is written to a 'notification@<key>' file, as
+    when the mailout is prepared without --store.
+    """
+
+    log = logging.getLogger(__name__ + '.Mailout.Export')
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument(
+            '--mailout-dir',
+            help='Directory where the mailout information was saved',
+        )
+        parser.add_argument(
+            '--output-dir',
+            help=(
+                'Directory to write the notification files to.  This '
+                'defaults to the mailout directory'
+            ),
+        )
+        return parser
+
+    def check_args(self, args):
+        if not args.mailout_dir:
+            raise Exception("--mailout-dir <directory> option is required")
+        self.store_path = os.path.join(args.mailout_dir, STORE_FILENAME)
+        if not os.path.exists(self.store_path):
+            raise Exception(
+                f"No notification store found in '{args.mailout_dir}'"
+            )
+        self.output_dir = args.output_dir or args.mailout_dir
+
+    def take_action(self, args):
+        self.check_args(args)
+        self.log.debug('take_action(%s)', args)
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        store = NotificationStore(self.store_path)
+        count = 0
+        try:
+            for notification in store.notifications():
+                filename = normalize_filename(
+                    f"notification@{notification['Key']}"
+                )
+                write_notification(
+                    os.path.join(self.output_dir, filename), notification
+                )
+                count += 1
+        finally:
+            store.close()
+        print(f"Exported {count} notifications into {self.output_dir}")
+
+
+# The Generator of a render worker process
+_render_generator = None
+
+
+def _init_render_worker(template, subject):
+    global _render_generator
+    _render_generator = Generator(template, subject)
+
+
+def render_notification(generator, content):
+    """Return the notification with its subject and body rendered
+
+    A 'generator' of None means the render worker's Generator.
+    """
+
+    generator = generator or _render_generator
+    context = content['Context']
+    return dict(
+        content,
+        Subject=generator.render_subject(context),
+        Body=generator.render_template(context),
+    )
+
+
+def dump_notification(generator, filepath, content):
+    "Render a notification and dump it to a new file"
+
+    write_notification(filepath, render_notification(generator, content))
 
-        notifications = {}
-        for filename in os.listdir(self.mailout_dir):
-            if filename.startswith('notification@'):
-                dumpfile = open(os.path.join(self.mailout_dir, filename))
-                notification = yaml.load(dumpfile, Loader=yaml.FullLoader)
-                notifications[notification['SeqNo']] = notification
 
-        return (notifications, last_sent)
+def write_notification(filepath, notification):
+    try:
+        with open(filepath, 'x') as dump:
+            dump_yaml(notification, dump)
+    except FileExistsError:
+        filename = os.path.basename(filepath)
+        raise Exception(f"Notification file {filename} already exists!")
 
 
 class Generator:
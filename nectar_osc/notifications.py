@@ -0,0 +1,463 @@
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+#
+
+import collections.abc
+from datetime import datetime
+from datetime import timezone
+import fcntl
+import json
+import os
+import re
+import sqlite3
+import threading
+import yaml
+
+
+# The name of the notification store in a mailout directory
+STORE_FILENAME = 'notifications.sqlite'
+# The name of the cached notification file index in a mailout directory
+INDEX_FILENAME = '.notifications.index'
+# The name of the send journal in a mailout directory
+JOURNAL_FILENAME = 'SENT.journal'
+
+# The names of the send journals, for the whole mailout or for a shard
+_JOURNAL_RE = re.compile(r'^SENT(?:-(\d+)-of-(\d+))?\.journal$')
+# The names of the locks held by sends of shards, by shard count
+_SHARD_LOCK_RE = re.compile(r'^SENT-of-(\d+)\.lock$')
+
+# Use the C YAML parser when it is available
+_Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# The SeqNo line in a notification file; keys are dumped unindented
+_SEQNO_RE = re.compile(r'^SeqNo: (\d+)$')
+# The keys that are dumped first, so that the index can read them
+# without reading the rest of the file
+_HEADER_KEYS = ('SeqNo', 'SendTo')
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, collections.abc.Mapping):
+        return dict(value)
+    raise TypeError(f"Can't save {type(value).__name__} in a notification")
+
+
+def dump_yaml(notification, stream):
+    """Dump a notification as YAML, with the SeqNo and SendTo first
+
+    The other keys follow in sorted order, as yaml.dump would put them.
+    """
+
+    header = {k: notification[k] for k in _HEADER_KEYS if k in notification}
+    rest = {k: v for k, v in notification.items() if k not in header}
+    yaml.dump(header, stream, default_flow_style=False, sort_keys=False)
+    yaml.dump(rest, stream, default_flow_style=False)
+
+
+def open_notifications(mailout_dir):
+    """Return a SeqNo to notification mapping for a mailout directory
+
+    The notification store is used if there is one, and otherwise the
+    'notification@<key>' files.  Either way notifications are only
+    loaded when they are looked up.
+    """
+
+    store_path = os.path.join(mailout_dir, STORE_FILENAME)
+    if os.path.exists(store_path):
+        return NotificationStore(store_path)
+    index = NotificationIndex(mailout_dir)
+    index.load()
+    return index
+
+
+class NotificationIndex(collections.abc.Mapping):
+    """Lazily loaded 'notification@<key>' files of a mailout directory
+
+    The SeqNo and recipient count of each file are read from its
+    header, without parsing the whole file, and the index of files is
+    cached in the mailout directory.  Cached entries are reused while
+    the file's mtime is unchanged.  Notifications are parsed when they
+    are looked up.
+
+    Files written by dump_yaml start with the SeqNo and SendTo, so only
+    the first few lines are read.  Older files have their keys sorted,
+    which puts these after the Body and Context, so most of the file is
+    read (but not parsed).
+    """
+
+    def __init__(self, mailout_dir):
+        self.mailout_dir = mailout_dir
+        self.index_path = os.path.join(mailout_dir, INDEX_FILENAME)
+        self.files = {}
+        self.recipients = {}
+
+    def __getitem__(self, seqno):
+        path = os.path.join(self.mailout_dir, self.files[seqno])
+        with open(path) as f:
+            return yaml.load(f, Loader=_Loader)
+
+    def __iter__(self):
+        return iter(sorted(self.files))
+
+    def __contains__(self, seqno):
+        return seqno in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def close(self):
+        pass
+
+    def recipient_count(self, seqno):
+        return self.recipients[seqno]
+
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                cached = json.load(f)
+        except (FileNotFoundError, ValueError):
+            cached = {}
+        entries = {}
+        with os.scandir(self.mailout_dir) as it:
+            for entry in it:
+                if not entry.name.startswith('notification@'):
+                    continue
+                mtime = entry.stat().st_mtime_ns
+                header = cached.get(entry.name)
+                if (
+                    header is None
+                    or header['mtime'] != mtime
+                    or 'recipients' not in header
+                ):
+                    header = dict(self._header(entry.path), mtime=mtime)
+                entries[entry.name] = header
+        self.files = {h['seqno']: name for (name, h) in entries.items()}
+        self.recipients = {
+            h['seqno']: h['recipients'] for h in entries.values()
+        }
+        if entries != cached:
+            self._save(entries)
+
+    def _header(self, path):
+        "Return the SeqNo and the number of recipients of a file"
+        seqno = None
+        recipients = None
+        in_send_to = False
+        with open(path) as f:
+            for line in f:
+                if in_send_to and line.startswith('- '):
+                    recipients += 1
+                    continue
+                in_send_to = False
+                if seqno is not None and recipients is not None:
+                    break
+                match = _SEQNO_RE.match(line)
+                if match:
+                    seqno = int(match.group(1))
+                elif line == 'SendTo: []\n':
+                    recipients = 0
+                elif line == 'SendTo:\n':
+                    (recipients, in_send_to) = (0, True)
+            if seqno is None or recipients is None:
+                # Not a file we dumped; fall back to parsing it
+                f.seek(0)
+                notification = yaml.load(f, Loader=_Loader)
+                seqno = notification['SeqNo']
+                recipients = len(notification['SendTo'])
+        return {'seqno': seqno, 'recipients': recipients}
+
+    def _save(self, entries):
+        tmp_path = f"{self.index_path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            # The index is only an optimization
+            pass
+
+
+class NotificationStore(collections.abc.Mapping):
+    """Single-file store for the notifications of a mailout
+
+    This is an alternative to a 'notification@<key>' YAML file per
+    notification.  The notifications are held in an SQLite table keyed
+    by sequence no, and are returned as the same dicts as the YAML files
+    hold.  The Context is saved as JSON, so timestamps in it come back
+    as ISO format strings.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS notifications ('
+            'seqno INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, '
+            'subject TEXT, body TEXT, send_to TEXT NOT NULL, context TEXT)'
+        )
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+    def commit(self):
+        self._db.commit()
+
+    def __len__(self):
+        return self._db.execute(
+            'SELECT COUNT(*) FROM notifications'
+        ).fetchone()[0]
+
+    def __iter__(self):
+        rows = self._db.execute(
+            'SELECT seqno FROM notifications ORDER BY seqno'
+        ).fetchall()
+        return (seqno for (seqno,) in rows)
+
+    def __contains__(self, seqno):
+        row = self._db.execute(
+            'SELECT 1 FROM notifications WHERE seqno = ?', (seqno,)
+        ).fetchone()
+        return row is not None
+
+    def recipient_count(self, seqno):
+        row = self._db.execute(
+            'SELECT send_to FROM notifications WHERE seqno = ?', (seqno,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(seqno)
+        return len(json.loads(row[0]))
+
+    def __getitem__(self, seqno):
+        row = self._db.execute(
+            'SELECT seqno, key, subject, body, send_to, context '
+            'FROM notifications WHERE seqno = ?',
+            (seqno,),
+        ).fetchone()
+        if row is None:
+            raise KeyError(seqno)
+        return self._notification(row)
+
+    def notifications(self):
+        "Generate all of the notifications in SeqNo order"
+        rows = self._db.execute(
+            'SELECT seqno, key, subject, body, send_to, context '
+            'FROM notifications ORDER BY seqno'
+        )
+        for row in rows:
+            yield self._notification(row)
+
+    def add(self, notification):
+        try:
+            self._db.execute(
+                'INSERT INTO notifications VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    notification['SeqNo'],
+                    notification['Key'],
+                    notification['Subject'],
+                    notification['Body'],
+                    json.dumps(notification['SendTo']),
+                    json.dumps(notification['Context'], default=_json_default),
+                ),
+            )
+        except sqlite3.IntegrityError:
+            raise Exception(
+                f"Notification {notification['Key']} already exists!"
+            )
+
+    @staticmethod
+    def _notification(row):
+        (seqno, key, subject, body, send_to, context) = row
+        return {
+            'SeqNo': seqno,
+            'Key': key,
+            'Subject': subject,
+            'Body': body,
+            'SendTo': json.loads(send_to),
+            'Context': json.loads(context),
+        }
+
+
+def journal_filename(shard=None):
+    "Return the send journal name for a (index, count) shard or all"
+    if shard is None:
+        return JOURNAL_FILENAME
+    return f"SENT-{shard[0]}-of-{shard[1]}.journal"
+
+
+def find_journals(mailout_dir):
+    """Return the send journals in a mailout directory
+
+    The result maps each journal's filename to its (index, count)
+    shard, or to None for the journal of an unsharded send.
+    """
+
+    journals = {}
+    for filename in sorted(os.listdir(mailout_dir)):
+        match = _JOURNAL_RE.match(filename)
+        if match:
+            journals[filename] = (
+                (int(match.group(1)), int(match.group(2)))
+                if match.group(1)
+                else None
+            )
+    return journals
+
+
+def _flock(path, operation):
+    "Open and lock a lock file, or return None if it is held elsewhere"
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+class SendLock:
+    """Lock on a mailout that stops sends of overlapping notifications
+
+    An unsharded send holds the mailout's lock exclusively.  A sharded
+    send holds it shared, along with a shared lock that records its
+    shard count, and is refused while shards of another count are being
+    sent.  Two sends of the same shard are stopped by the lock of the
+    shard's journal.
+    """
+
+    def __init__(self, mailout_dir, shard=None):
+        self.mailout_dir = mailout_dir
+        self.shard = shard
+        self.lock_files = []
+
+    def acquire(self):
+        "Take the lock; raises an Exception if an overlapping send holds it"
+        path = os.path.join(self.mailout_dir, 'SENT.lock')
+        if self.shard is None:
+            self._lock(path, fcntl.LOCK_EX, "part of this mailout")
+            return
+        self._lock(path, fcntl.LOCK_SH, "all of this mailout")
+        count = self.shard[1]
+        count_file = open(
+            os.path.join(self.mailout_dir, f"SENT-of-{count}.lock"), 'a'
+        )
+        # Blocks only while another send is checking for this count
+        fcntl.flock(count_file, fcntl.LOCK_SH)
+        self.lock_files.append(count_file)
+        for filename in sorted(os.listdir(self.mailout_dir)):
+            match = _SHARD_LOCK_RE.match(filename)
+            if match and int(match.group(1)) != count:
+                self._lock(
+                    os.path.join(self.mailout_dir, filename),
+                    fcntl.LOCK_EX,
+                    f"this mailout in {match.group(1)} shards",
+                )
+                # Nobody is sending shards of that count
+                self.lock_files.pop().close()
+
+    def _lock(self, path, operation, what):
+        lock_file = _flock(path, operation)
+        if lock_file is None:
+            self.release()
+            raise Exception(f"Another process is already sending {what}")
+        self.lock_files.append(lock_file)
+
+    def release(self):
+        while self.lock_files:
+            self.lock_files.pop().close()
+
+
+class SendJournal:
+    """Append-only journal of the notifications sent from a mailout
+
+    Each line records the SeqNo of a sent notification, when it was sent
+    and the id of the message that taynac created, if any.  Lines are
+    flushed as they are written, and synced to disk in batches.  A line
+    truncated by a crash is ignored when the journal is loaded.
+    """
+
+    def __init__(self, path, sync_every=50):
+        self.path = path
+        self.sync_every = sync_every
+        self.unsynced = 0
+        self.lock = threading.Lock()
+        self.file = None
+        self.lock_file = None
+
+    def load(self):
+        "Return the journal entries by SeqNo"
+        entries = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    entries[entry['seqno']] = entry
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def acquire(self):
+        """Take the journal's lock, for the duration of a send
+
+        Returns False if another process holds the lock.
+        """
+
+        self.lock_file = _flock(f"{self.path}.lock", fcntl.LOCK_EX)
+        return self.lock_file is not None
+
+    def is_active(self):
+        "Is a process sending with this journal?"
+        if self.lock_file is not None:
+            return True
+        if not os.path.exists(f"{self.path}.lock"):
+            return False
+        if self.acquire():
+            self.release()
+            return False
+        return True
+
+    def release(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def record(self, seqno, message_id=None):
+        entry = {
+            'seqno': seqno,
+            'time': datetime.now(timezone.utc).isoformat(),
+            'id': message_id,
+        }
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self._sync()
+                self.file.close()
+                self.file = None
+        self.release()
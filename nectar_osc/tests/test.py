@@ -15,6 +15,7 @@ import os
 import unittest
 
 from nectar_osc import config
+from nectar_osc import identity
 
 filename = os.path.realpath(
     os.path.join(os.path.dirname(__file__), 'nectar-osc.conf')
@@ -26,3 +27,11 @@ config.init(filename)
 class TestCase(unittest.TestCase):
     def setUp(self):
         super().setUp()
+        # Start every test with empty identity caches
+        for cache in (
+            identity.project_cache,
+            identity.user_cache,
+            identity.role_cache,
+            identity.assignment_cache,
+        ):
+            cache.clear()
@@ -11,10 +11,12 @@
 # limitations under the License.
 
 from collections import defaultdict
+import re
 
 import keystoneauth1
 import keystoneclient
 import openstack
+from openstack.compute.v2 import server as sdk_server
 
 
 # Fake osc clients for identity and compute.
@@ -28,19 +30,35 @@ class FakeClients:
 
 
 class FakeIdentity:
-    def __init__(self, users=[], projects=[], roles=[], assignments=[]):
+    def __init__(
+        self, users=[], projects=[], roles=[], assignments=[], members={}
+    ):
+        self.session = FakeSession('https://keystone.example.org:5000/v3/')
         self.users = FakeUsers(users)
         self.projects = FakeProjects(projects)
         self.roles = FakeRoles(roles)
-        self.role_assignments = FakeRoleAssignments(assignments)
+        self.role_assignments = FakeRoleAssignments(assignments, members)
         for obj in assignments:
             setattr(obj, 'identity', self)
 
 
+class FakeSession:
+    def __init__(self, auth_url):
+        self.auth = FakeAuth(auth_url)
+
+
+class FakeAuth:
+    def __init__(self, auth_url):
+        self.auth_url = auth_url
+
+
 class FakeUsers:
     def __init__(self, users=[]):
         self.users = users
 
+    def list(self):
+        return list(self.users)
+
     def get(self, id):
         for user in self.users:
             if user.id == id:
@@ -88,11 +106,17 @@ class FakeRole:
         self.id = id
         self.name = name
 
+    def __getitem__(self, key):
+        return getattr(self, key)
+
 
 class FakeProjects:
     def __init__(self, projects=[]):
         self.projects = projects
 
+    def list(self):
+        return list(self.projects)
+
     def get(self, id):
         for project in self.projects:
             if project.id == id:
@@ -113,28 +137,51 @@ class FakeProject:
 
 
 class FakeRoleAssignments:
-    def __init__(self, assignments=[]):
+    def __init__(self, assignments=[], members={}):
         self.assignments = assignments
+        # The user ids of the members of each group
+        self.members = members
 
-    def list(self, project, role, include_names):
-        return [
-            ra
-            for ra in self.assignments
-            if project == ra.project and role == ra.role
-        ]
+    def list(
+        self, project=None, role=None, effective=False, include_names=False
+    ):
+        role_id = getattr(role, 'id', role)
+        res = []
+        for ra in self.assignments:
+            if project not in (None, ra.project):
+                continue
+            if role_id not in (None, ra.role_id):
+                continue
+            if effective and ra.group_id:
+                # Group assignments are replaced by their members'
+                for user_id in self.members.get(ra.group_id, []):
+                    member = FakeRoleAssignment(
+                        ra.project, ra.role_id, user_id=user_id
+                    )
+                    member.identity = ra.identity
+                    res.append(member)
+            else:
+                res.append(ra)
+        return res
 
 
 class FakeRoleAssignment:
-    def __init__(self, project_id, role_id, user_id):
+    def __init__(self, project_id, role_id, user_id=None, group_id=None):
         self.project = project_id
         self.role_id = role_id
         self.user_id = user_id
+        self.group_id = group_id
 
     def __getattr__(self, name):
+        # Like keystone, a group assignment has no 'user'
         if name == 'role':
             return self.identity.roles.get(self.role_id)
-        elif name == 'user':
+        elif name == 'user' and self.user_id:
             return self.identity.users.get(self.user_id)
+        elif name == 'group' and self.group_id:
+            return {'id': self.group_id}
+        elif name == 'scope':
+            return {'project': {'id': self.project}}
         else:
             raise AttributeError(name)
 
@@ -143,6 +190,9 @@ class FakeCompute:
     def __init__(self, servers=[], max_response=None):
         self.servers = FakeServers(servers, max_response)
 
+    def get_server(self, id):
+        return self.servers.get_server(id)
+
 
 class FakeServers:
     def __init__(self, servers=[], max_response=None):
@@ -156,6 +206,14 @@ class FakeServers:
         raise openstack.exceptions.NotFoundException()
 
     def __call__(self, **search_opts):
+        # Reject the query params that the real SDK would reject
+        invalid = set(search_opts) - set(
+            sdk_server.Server._query_mapping._mapping
+        )
+        if invalid:
+            raise openstack.exceptions.InvalidResourceQuery(
+                f"Invalid query params: {','.join(sorted(invalid))}"
+            )
         res = []
         limit_opt = search_opts.get('limit', None)
         limit = int(limit_opt) if limit_opt else 0
@@ -164,6 +222,10 @@ class FakeServers:
         status = search_opts.get('status', None)
         image = search_opts.get('image', None)
         compute_host = search_opts.get('compute_host', None)
+        zone = search_opts.get('availability_zone', None)
+        ip = search_opts.get('ipv4_address', None) or search_opts.get(
+            'ipv6_address', None
+        )
         marker = search_opts.get('marker', None)
         for server in self.servers:
             if marker:
@@ -185,6 +247,16 @@ class FakeServers:
                 continue
             if compute_host and compute_host != server.compute_host:
                 continue
+            if zone and not re.search(
+                zone, server['OS-EXT-AZ:availability_zone']
+            ):
+                continue
+            if ip and not any(
+                re.match(ip, addr['addr'])
+                for addrs in server.addresses.values()
+                for addr in addrs
+            ):
+                continue
 
             res.append(server)
         return res
@@ -363,6 +435,10 @@ ROLES = [
         id='77777777-1111-11111-1111-111111111112',
         name='TenantManager',
     ),
+    FakeRole(
+        id='77777777-1111-11111-1111-111111111113',
+        name='reader',
+    ),
 ]
 
 
@@ -392,6 +468,11 @@ ASSIGNMENTS = [
         project_id='44444444-1111-1111-1111-111111111112',
         role_id='77777777-1111-11111-1111-111111111112',
     ),
+    FakeRoleAssignment(
+        group_id='55555555-1111-1111-1111-111111111111',
+        project_id='44444444-1111-1111-1111-111111111111',
+        role_id='77777777-1111-11111-1111-111111111113',
+    ),
 ]
 
 
@@ -401,6 +482,7 @@ def make_fake_clients(
     servers=SERVERS,
     roles=ROLES,
     assignments=ASSIGNMENTS,
+    members={},
     max_response=None,
     taynac=None,
 ):
@@ -411,6 +493,7 @@ def make_fake_clients(
             projects=projects,
             roles=roles,
             assignments=assignments,
+            members=members,
         ),
         taynac=taynac,
     )
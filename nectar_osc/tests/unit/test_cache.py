@@ -0,0 +1,178 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+from unittest import mock
+
+from oslo_config import cfg
+
+from nectar_osc import cache
+from nectar_osc import identity
+from nectar_osc.tests import test
+from nectar_osc.tests.unit import fakes
+
+
+class TestCache(test.TestCase):
+    def test_get_and_stats(self):
+        c = cache.Cache('test', max_size=10, ttl=0)
+        c['a'] = 1
+        self.assertEqual(1, c.get('a'))
+        self.assertEqual(1, c['a'])
+        self.assertIsNone(c.get('b'))
+        self.assertEqual('x', c.get('b', 'x'))
+        with self.assertRaises(KeyError):
+            c['b']
+        self.assertIn('a', c)
+        self.assertNotIn('b', c)
+        self.assertEqual(
+            {
+                'name': 'test',
+                'size': 1,
+                'hits': 2,
+                'misses': 3,
+                'evictions': 0,
+                'loads': 0,
+            },
+            c.stats(),
+        )
+        c.clear()
+        self.assertEqual(0, len(c))
+        self.assertEqual(0, c.stats()['misses'])
+
+    def test_lru_eviction(self):
+        c = cache.Cache('test', max_size=2, ttl=0)
+        c['a'] = 1
+        c['b'] = 2
+        # Using 'a' makes 'b' the least recently used entry
+        c.get('a')
+        c['c'] = 3
+        self.assertIn('a', c)
+        self.assertNotIn('b', c)
+        self.assertIn('c', c)
+        self.assertEqual(1, c.stats()['evictions'])
+
+    def test_ttl(self):
+        c = cache.Cache('test', max_size=0, ttl=60)
+        with mock.patch.object(cache.time, 'monotonic', return_value=1000):
+            c['a'] = 1
+        with mock.patch.object(cache.time, 'monotonic', return_value=1059):
+            self.assertEqual(1, c.get('a'))
+        with mock.patch.object(cache.time, 'monotonic', return_value=1060):
+            self.assertIsNone(c.get('a'))
+        self.assertEqual(0, len(c))
+
+    def test_config_defaults(self):
+        c = cache.Cache('test')
+        self.assertEqual(100000, c.max_size)
+        self.assertEqual(3600, c.ttl)
+
+    def _persistent_store(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        path = os.path.join(tmp_dir.name, 'cache.sqlite')
+        cfg.CONF.set_override('persistent', True, 'cache')
+        cfg.CONF.set_override('path', path, 'cache')
+        self.addCleanup(cfg.CONF.clear_override, 'persistent', 'cache')
+        self.addCleanup(cfg.CONF.clear_override, 'path', 'cache')
+        self.addCleanup(setattr, cache, '_store', None)
+        self.addCleanup(setattr, cache, '_cloud', None)
+        self.addCleanup(lambda: cache._store and cache._store.close())
+        return path
+
+    def test_persistent(self):
+        path = self._persistent_store()
+        clients = fakes.make_fake_clients()
+        user = identity.get_user(
+            clients.identity, 'fred.nurke@gmail.com', use_cache=True
+        )
+        self.assertTrue(os.path.exists(path))
+
+        # A new process starts with an empty memory cache
+        identity.user_cache.clear()
+        with mock.patch.object(clients.identity.users, 'find') as mock_find:
+            cached = identity.get_user(
+                clients.identity, 'fred.nurke@gmail.com', use_cache=True
+            )
+        mock_find.assert_not_called()
+        self.assertIsInstance(cached, cache.Resource)
+        self.assertEqual(user.id, cached.id)
+        self.assertEqual(user.email, cached['email'])
+        self.assertEqual(1, identity.user_cache.stats()['loads'])
+
+        # Expired entries are not loaded
+        identity.user_cache.clear()
+        with mock.patch.object(cache.time, 'time', return_value=2e9):
+            self.assertIsNone(identity.user_cache.get(user.id))
+
+    def test_persistent_expiry(self):
+        self._persistent_store()
+        cache.use_cloud(fakes.FakeIdentity())
+        c = cache.Cache('test', max_size=0, ttl=60, persistent=True)
+        with mock.patch.object(cache.time, 'time', return_value=1000):
+            c['a'] = 1
+        c.clear()
+        # A loaded entry keeps the expiry it was stored with
+        with (
+            mock.patch.object(cache.time, 'time', return_value=1050),
+            mock.patch.object(cache.time, 'monotonic', return_value=500),
+        ):
+            self.assertEqual(1, c.get('a'))
+        with mock.patch.object(cache.time, 'monotonic', return_value=509):
+            self.assertEqual(1, c.get('a'))
+        with (
+            mock.patch.object(cache.time, 'time', return_value=1060),
+            mock.patch.object(cache.time, 'monotonic', return_value=510),
+        ):
+            self.assertIsNone(c.get('a'))
+
+    def test_persistent_clouds(self):
+        self._persistent_store()
+        clients = fakes.make_fake_clients()
+        identity.get_role(clients.identity, 'Member')
+        identity.role_cache.clear()
+
+        # Another cloud's roles aren't loaded
+        other = fakes.make_fake_clients()
+        other.identity.session = fakes.FakeSession(
+            'https://keystone.other.org:5000/v3/'
+        )
+        with mock.patch.object(
+            other.identity.roles, 'find', wraps=other.identity.roles.find
+        ) as mock_find:
+            identity.get_role(other.identity, 'Member')
+        mock_find.assert_called_once_with(name='Member')
+        self.assertEqual(0, identity.role_cache.stats()['loads'])
+
+        # Nothing is stored when the cloud isn't known
+        cache.use_cloud(object())
+        self.assertIsNone(cache.get_store())
+
+    def test_invalidate(self):
+        path = self._persistent_store()
+        cache.use_cloud(fakes.FakeIdentity())
+        store = cache.get_store()
+        store.set('x', 'user', 'a', {'id': 'a'})
+        store.set('y', 'user', 'b', {'id': 'b'})
+        store.set('x', 'project', 'a', {'id': 'a'})
+
+        command = cache.InvalidateCache(mock.Mock(), mock.Mock())
+        parser = command.get_parser('invalidate')
+        command.take_action(parser.parse_args(['--kind', 'user', 'a']))
+        self.assertIsNone(store.get('x', 'user', 'a'))
+        self.assertEqual(({'id': 'b'}, None), store.get('y', 'user', 'b'))
+        self.assertEqual(({'id': 'a'}, None), store.get('x', 'project', 'a'))
+
+        command.take_action(parser.parse_args([]))
+        self.assertIsNone(store.get('y', 'user', 'b'))
+        self.assertIsNone(store.get('x', 'project', 'a'))
+        self.assertTrue(os.path.exists(path))
@@ -10,6 +10,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import datetime
+import os
+import tempfile
+import time
+from unittest import mock
+
+from openstack import exceptions as sdk_exceptions
+from oslo_config import cfg
 
 from nectar_osc import compute
 from nectar_osc.tests import test
@@ -43,6 +52,26 @@ class TestCompute(test.TestCase):
         self.assertEqual('area54', info['project_name'])
         self.assertEqual('twilight', info['zone'])
 
+    def test_instance_record(self):
+        record = compute.InstanceRecord(id='x', name='one')
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertEqual('one', record['name'])
+        self.assertEqual('one', record.name)
+        self.assertIsNone(record['email'])
+        self.assertEqual(len(compute.InstanceRecord.__slots__), len(record))
+        record['email'] = 'fred.nurke@gmail.com'
+        self.assertEqual(
+            dict.fromkeys(compute.InstanceRecord.__slots__)
+            | {'id': 'x', 'name': 'one', 'email': 'fred.nurke@gmail.com'},
+            dict(record),
+        )
+        with self.assertRaises(KeyError):
+            record['colour']
+        with self.assertRaises(KeyError):
+            record['colour'] = 'red'
+        with self.assertRaises(TypeError):
+            compute.InstanceRecord(colour='red')
+
     def test_all_instances(self):
         clients = fakes.make_fake_clients()
         all = compute.all_instances(clients)
@@ -149,3 +178,404 @@ class TestCompute(test.TestCase):
         clients = fakes.make_fake_clients(max_response=1)
         all = compute.all_instances(clients)
         self.assertEqual(len(fakes.SERVERS), len(all))
+
+    def test_all_instances_concurrent_hosts(self):
+        clients = fakes.make_fake_clients()
+        hosts = ['cn3', 'cn1', 'cn2']
+        serial = compute.all_instances(clients, hosts=hosts)
+        concurrent = compute.all_instances(clients, hosts=hosts, workers=3)
+        self.assertEqual(
+            [i['id'] for i in serial], [i['id'] for i in concurrent]
+        )
+        self.assertEqual(
+            [
+                '00000000-1111-1111-1111-111111111114',
+                '00000000-1111-1111-1111-111111111111',
+                '00000000-1111-1111-1111-111111111112',
+                '00000000-1111-1111-1111-111111111113',
+            ],
+            [i['id'] for i in concurrent],
+        )
+        limited = compute.all_instances(
+            clients, hosts=hosts, workers=3, limit=2
+        )
+        self.assertEqual(
+            [i['id'] for i in concurrent[:2]], [i['id'] for i in limited]
+        )
+
+    def test_all_instances_concurrent_limit(self):
+        # Many instances on cn1, which take many pages to list
+        servers = []
+        for i in range(20):
+            server = copy.deepcopy(fakes.SERVERS[0])
+            server.id = f'00000000-2222-2222-2222-{i:012}'
+            servers.append(server)
+        clients = fakes.make_fake_clients(
+            servers=fakes.SERVERS + servers, max_response=1
+        )
+        list_servers = clients.compute.servers
+        calls = []
+
+        def slow_servers(**opts):
+            calls.append(opts)
+            time.sleep(0.05)
+            return list_servers(**opts)
+
+        clients.compute.servers = slow_servers
+        limited = compute.all_instances(
+            clients, hosts=['cn3', 'cn1'], workers=2, limit=1
+        )
+        self.assertEqual(1, len(limited))
+        # No listing is left paging Nova once the limit is reached
+        made = len(calls)
+        time.sleep(0.2)
+        self.assertEqual(made, len(calls))
+
+        # Nor when the consumer stops early, e.g. because it failed
+        calls.clear()
+        instances = compute.iter_instances(
+            clients, hosts=['cn3', 'cn1'], workers=2
+        )
+        next(instances)
+        instances.close()
+        made = len(calls)
+        self.assertLess(made, len(servers))
+        time.sleep(0.2)
+        self.assertEqual(made, len(calls))
+
+    def test_all_instances_concurrent_extraction(self):
+        clients = fakes.make_fake_clients(max_response=1)
+        serial = compute.all_instances(clients)
+        concurrent = compute.all_instances(clients, extract_workers=4)
+        self.assertEqual(serial, concurrent)
+        limited = compute.all_instances(clients, extract_workers=4, limit=3)
+        self.assertEqual(serial[:3], limited)
+
+    def test_iter_instances(self):
+        clients = fakes.make_fake_clients(max_response=1)
+        clients.compute.servers = mock.Mock(wraps=clients.compute.servers)
+        instances = compute.iter_instances(clients, limit=1)
+        clients.compute.servers.assert_not_called()
+        self.assertEqual(
+            '00000000-1111-1111-1111-111111111111', next(instances)['id']
+        )
+        self.assertRaises(StopIteration, next, instances)
+        self.assertEqual(1, clients.compute.servers.call_count)
+
+    def test_all_instances_pushdown(self):
+        clients = fakes.make_fake_clients()
+        clients.compute.servers = mock.Mock(wraps=clients.compute.servers)
+        self.assertEqual(
+            1, len(compute.all_instances(clients, zones=['twilight']))
+        )
+        self.assertEqual(
+            mock.call(all_projects=True, availability_zone='^twilight$'),
+            clients.compute.servers.call_args_list[0],
+        )
+
+        clients.compute.servers.reset_mock()
+        self.assertEqual(
+            4,
+            len(compute.all_instances(clients, zones=['twilight', 'danger'])),
+        )
+        clients.compute.servers.assert_any_call(
+            all_projects=True, availability_zone='^twilight$'
+        )
+        clients.compute.servers.assert_any_call(
+            all_projects=True, availability_zone='^danger$'
+        )
+
+        # A zone doesn't match other zones that it is a prefix of
+        clients.compute.servers.reset_mock()
+        self.assertEqual([], compute.all_instances(clients, zones=['dang']))
+        clients.compute.servers.assert_called_once_with(
+            all_projects=True, availability_zone='^dang$'
+        )
+
+        # Addresses aren't pushed down by default, as Nova doesn't
+        # search floating IPs
+        clients.compute.servers.reset_mock()
+        instances = compute.all_instances(clients, ips=['192.168.76.112'])
+        self.assertEqual(1, len(instances))
+        self.assertEqual(
+            mock.call(all_projects=True),
+            clients.compute.servers.call_args_list[0],
+        )
+
+        cfg.CONF.set_override('ip_pushdown', True, 'nova')
+        self.addCleanup(cfg.CONF.clear_override, 'ip_pushdown', 'nova')
+        clients.compute.servers.reset_mock()
+        instances = compute.all_instances(
+            clients, ips=['192.168.76.112', '192.168.76.1'], workers=2
+        )
+        # Nova's matches are checked, so 192.168.76.1 doesn't match
+        # 192.168.76.112
+        self.assertEqual(
+            ['00000000-1111-1111-1111-111111111112'],
+            [i['id'] for i in instances],
+        )
+        clients.compute.servers.assert_any_call(
+            all_projects=True, ipv4_address='192.168.76.112'
+        )
+        clients.compute.servers.assert_any_call(
+            all_projects=True, ipv4_address='192.168.76.1'
+        )
+
+        # A pushed down address is not exact, so the page isn't cut
+        # down to the limit
+        clients.compute.servers.reset_mock()
+        instances = compute.all_instances(
+            clients, ips=['192.168.76.1'], limit=1
+        )
+        self.assertEqual([], instances)
+        self.assertEqual(
+            mock.call(all_projects=True, ipv4_address='192.168.76.1'),
+            clients.compute.servers.call_args_list[0],
+        )
+
+        # Networks can't be pushed down, and overlapping matches are
+        # only produced once
+        clients.compute.servers.reset_mock()
+        instances = compute.all_instances(
+            clients, ips=['192.168.76.0/24', '192.168.76.123'], workers=2
+        )
+        self.assertEqual(len(fakes.SERVERS), len(instances))
+        clients.compute.servers.assert_any_call(all_projects=True)
+        self.assertEqual(
+            2,
+            len(compute.all_instances(clients, ips=['192.168.76.120/29'])),
+        )
+
+    def _http_error(self, status_code):
+        return sdk_exceptions.HttpException(
+            response=mock.Mock(status_code=status_code, headers={})
+        )
+
+    def test_page_sizer(self):
+        sizer = compute.PageSizer(-1, 100, 1000, 10.0)
+        self.assertEqual(100, sizer.size)
+        sizer.record(100, 1.0)
+        self.assertEqual(200, sizer.size)
+        # A short (last) page is no reason to grow
+        sizer.record(50, 1.0)
+        self.assertEqual(200, sizer.size)
+        sizer.record(200, 7.0)
+        self.assertEqual(200, sizer.size)
+        sizer.record(200, 11.0)
+        self.assertEqual(100, sizer.size)
+        for i in range(10):
+            sizer.record(sizer.size, 0.1)
+        self.assertEqual(1000, sizer.size)
+        self.assertTrue(sizer.failed())
+        self.assertEqual(500, sizer.size)
+        sizer = compute.PageSizer(100, 100, 1000, 10.0)
+        self.assertFalse(sizer.failed())
+
+    @mock.patch('nectar_osc.compute._backoff')
+    def test_all_instances_adaptive_paging(self, mock_backoff):
+        cfg.CONF.set_override('adaptive_paging', True, 'nova')
+        cfg.CONF.set_override('min_page_size', 1, 'nova')
+        cfg.CONF.set_override('max_page_size', 2, 'nova')
+        self.addCleanup(cfg.CONF.clear_override, 'adaptive_paging', 'nova')
+        self.addCleanup(cfg.CONF.clear_override, 'min_page_size', 'nova')
+        self.addCleanup(cfg.CONF.clear_override, 'max_page_size', 'nova')
+
+        clients = fakes.make_fake_clients()
+        servers = clients.compute.servers
+        failures = [self._http_error(504)]
+
+        def flaky_servers(**opts):
+            if opts['limit'] == 2 and failures:
+                raise failures.pop()
+            return servers(**opts)
+
+        clients.compute.servers = mock.Mock(side_effect=flaky_servers)
+        instances = compute.all_instances(clients)
+        self.assertEqual(
+            [s.id for s in fakes.SERVERS], [i['id'] for i in instances]
+        )
+        self.assertEqual(
+            [1, 2, 1, 2, 2],
+            [c.kwargs['limit'] for c in clients.compute.servers.mock_calls],
+        )
+
+        # Errors that aren't transient are not retried
+        clients.compute.servers = mock.Mock(side_effect=self._http_error(403))
+        with self.assertRaises(sdk_exceptions.HttpException):
+            compute.all_instances(clients)
+
+    @mock.patch('nectar_osc.compute._backoff')
+    def test_all_instances_retry(self, mock_backoff):
+        clients = fakes.make_fake_clients(max_response=1)
+        servers = clients.compute.servers
+        failures = [self._http_error(503), self._http_error(502)]
+
+        def flaky_servers(**opts):
+            if opts.get('marker') == fakes.SERVERS[1].id and failures:
+                raise failures.pop()
+            return servers(**opts)
+
+        clients.compute.servers = mock.Mock(side_effect=flaky_servers)
+        instances = compute.all_instances(clients)
+        self.assertEqual(
+            [s.id for s in fakes.SERVERS], [i['id'] for i in instances]
+        )
+        mock_backoff.assert_has_calls([mock.call(1), mock.call(2)])
+
+        # Give up after 'page_retries' retries
+        failures[:] = [self._http_error(503)] * 4
+        with self.assertRaises(sdk_exceptions.HttpException):
+            compute.all_instances(clients)
+        self.assertEqual([], failures)
+
+    def test_all_instances_stuck_marker(self):
+        clients = fakes.make_fake_clients()
+        # Simulate a Nova that keeps returning the marker instance
+        clients.compute.servers = mock.Mock(return_value=fakes.SERVERS[:2])
+        self.assertEqual(2, len(compute.all_instances(clients)))
+        self.assertEqual(2, clients.compute.servers.call_count)
+
+    def test_all_instances_checkpoint(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        path = os.path.join(tmp_dir.name, 'listing.checkpoint')
+        clients = fakes.make_fake_clients(max_response=1)
+        servers = clients.compute.servers
+        expected = compute.all_instances(clients, hosts=['cn3', 'cn1'])
+
+        # Interrupt the listing in the second page of the cn1 listing
+        calls = []
+
+        def failing_servers(**opts):
+            calls.append(opts)
+            if len(calls) > 3:
+                raise sdk_exceptions.HttpException(
+                    response=mock.Mock(status_code=403, headers={})
+                )
+            return servers(**opts)
+
+        clients.compute.servers = mock.Mock(side_effect=failing_servers)
+        checkpoint = compute.ListingCheckpoint(path)
+        instances = compute.iter_instances(
+            clients, hosts=['cn3', 'cn1'], checkpoint=checkpoint
+        )
+        self.assertEqual(expected[0], next(instances))
+        self.assertEqual(expected[1], next(instances))
+        with self.assertRaises(sdk_exceptions.HttpException):
+            next(instances)
+        (records, position) = checkpoint.load()
+        self.assertEqual(expected[:2], records)
+        self.assertEqual((1, expected[1]['id']), position)
+
+        # Resume from the checkpoint
+        clients.compute.servers = mock.Mock(wraps=servers)
+        resumed = compute.all_instances(
+            clients, hosts=['cn3', 'cn1'], checkpoint=checkpoint
+        )
+        self.assertEqual(expected, resumed)
+        clients.compute.servers.assert_any_call(
+            all_projects=True, compute_host='cn1', marker=expected[1]['id']
+        )
+        self.assertNotIn(
+            mock.call(all_projects=True, compute_host='cn3'),
+            clients.compute.servers.mock_calls,
+        )
+
+        # The completed listing is replayed without asking Nova
+        clients.compute.servers.reset_mock()
+        self.assertEqual(
+            expected,
+            compute.all_instances(
+                clients, hosts=['cn3', 'cn1'], checkpoint=checkpoint
+            ),
+        )
+        clients.compute.servers.assert_not_called()
+
+        # The checkpoint is stale once it is older than the TTL
+        self.assertFalse(checkpoint.is_stale())
+        later = datetime.datetime.now(
+            datetime.timezone.utc
+        ) + datetime.timedelta(hours=25)
+        self.assertTrue(checkpoint.is_stale(later))
+        checkpoint.remove()
+        self.assertTrue(checkpoint.is_stale())
+        self.assertFalse(os.path.exists(path))
+
+    def test_all_instances_trove(self):
+        trove_id = '44444444-1111-1111-1111-111111111113'
+        clients = fakes.make_fake_clients()
+        clients.compute.servers = mock.Mock(wraps=clients.compute.servers)
+        instances = compute.all_instances(
+            clients,
+            project_id='44444444-1111-1111-1111-111111111112',
+            hosts=['cn2', 'cn3'],
+        )
+        self.assertEqual(['database', 'three'], [i['name'] for i in instances])
+        clients.compute.servers.assert_any_call(
+            all_projects=True, project_id=trove_id, compute_host='cn3'
+        )
+
+        # No separate trove listing when searching the trove project
+        clients.compute.servers.reset_mock()
+        compute.all_instances(clients, project_id=trove_id)
+        # One page with the instance, and an empty one
+        self.assertEqual(2, clients.compute.servers.call_count)
+
+    def test_all_instances_no_trove(self):
+        clients = fakes.make_fake_clients(projects=fakes.PROJECTS[:2])
+        instances = compute.all_instances(
+            clients, project_id='44444444-1111-1111-1111-111111111112'
+        )
+        self.assertEqual(['three'], [i['name'] for i in instances])
+        self.assertIsNone(
+            compute.service_project_id(clients.identity, 'trove')
+        )
+
+    def test_all_instances_limit_paging(self):
+        clients = fakes.make_fake_clients()
+        clients.compute.servers = mock.Mock(wraps=clients.compute.servers)
+        instances = compute.all_instances(clients, limit=2)
+        self.assertEqual(2, len(instances))
+        clients.compute.servers.assert_called_once_with(
+            all_projects=True, limit=2
+        )
+
+        # Each zone query asks for what is still needed
+        clients.compute.servers.reset_mock()
+        instances = compute.all_instances(
+            clients, zones=['twilight', 'danger'], limit=3
+        )
+        self.assertEqual(3, len(instances))
+        self.assertEqual(
+            [
+                mock.call(
+                    all_projects=True, availability_zone='^twilight$', limit=3
+                ),
+                mock.call(
+                    all_projects=True,
+                    availability_zone='^twilight$',
+                    limit=2,
+                    marker=fakes.SERVERS[0].id,
+                ),
+                mock.call(
+                    all_projects=True, availability_zone='^danger$', limit=2
+                ),
+            ],
+            clients.compute.servers.mock_calls,
+        )
+
+        # The page size is left alone when servers are filtered
+        # client-side, but paging stops as soon as the limit is reached
+        clients = fakes.make_fake_clients(max_response=1)
+        clients.compute.servers = mock.Mock(wraps=clients.compute.servers)
+        instances = compute.all_instances(
+            clients, ips=['192.168.76.0/24'], limit=2
+        )
+        self.assertEqual(2, len(instances))
+        self.assertEqual(
+            [
+                mock.call(all_projects=True),
+                mock.call(all_projects=True, marker=fakes.SERVERS[0].id),
+            ],
+            clients.compute.servers.mock_calls,
+        )
@@ -10,15 +10,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import unittest
+import os
+import tempfile
+from unittest import mock
 
 from keystoneauth1.exceptions.http import NotFound
 
 from nectar_osc import identity
+from nectar_osc.tests import test
 from nectar_osc.tests.unit import fakes
 
 
-class TestIdentity(unittest.TestCase):
+class TestIdentity(test.TestCase):
     def test_get_user(self):
         clients = fakes.make_fake_clients()
         with self.assertRaises(NotFound):
@@ -33,6 +36,48 @@ class TestIdentity(unittest.TestCase):
             identity.get_project(clients.identity, 'route66')
         self.assertIsNotNone(identity.get_project(clients.identity, 'area54'))
 
+    def test_get_project_cache_by_name(self):
+        clients = fakes.make_fake_clients()
+        projects = clients.identity.projects
+        with (
+            mock.patch.object(projects, 'get', wraps=projects.get) as get,
+            mock.patch.object(projects, 'find', wraps=projects.find) as find,
+        ):
+            for _ in range(2):
+                project = identity.get_project(
+                    clients.identity, 'area54', use_cache=True
+                )
+                self.assertEqual(
+                    '44444444-1111-1111-1111-111111111111', project.id
+                )
+            # A name is looked up with 'find' once, and then by id
+            # from the cache
+            get.assert_not_called()
+            find.assert_called_once_with(name='area54')
+            self.assertIs(
+                project,
+                identity.get_project(
+                    clients.identity, project.id, use_cache=True
+                ),
+            )
+            get.assert_not_called()
+
+    def test_get_user_negative_cache(self):
+        clients = fakes.make_fake_clients()
+        users = clients.identity.users
+        missing = '33333333-1111-1111-1111-999999999999'
+        with (
+            mock.patch.object(users, 'get', wraps=users.get) as get,
+            mock.patch.object(users, 'find', wraps=users.find) as find,
+        ):
+            for _ in range(2):
+                with self.assertRaises(NotFound):
+                    identity.get_user(
+                        clients.identity, missing, use_cache=True
+                    )
+            get.assert_called_once_with(missing)
+            find.assert_called_once_with(name=missing)
+
     def test_get_roles(self):
         clients = fakes.make_fake_clients()
         self.assertIsNotNone(identity.get_role(clients.identity, 'Member'))
@@ -50,3 +95,158 @@ class TestIdentity(unittest.TestCase):
         self.assertEqual(
             ['terry.towling@gmail.com', 'fred.nurke@gmail.com'], emails
         )
+
+    def test_get_user_emails_with_roles_batched(self):
+        clients = fakes.make_fake_clients()
+        ras = clients.identity.role_assignments
+        with mock.patch.object(ras, 'list', wraps=ras.list) as mock_list:
+            emails = identity.get_user_emails_with_roles(
+                clients.identity,
+                project_id='44444444-1111-1111-1111-111111111111',
+                role_names=['TenantManager', 'Member'],
+            )
+        mock_list.assert_called_once_with(
+            project='44444444-1111-1111-1111-111111111111',
+            effective=True,
+            include_names=True,
+        )
+        # Tenant managers come first
+        self.assertEqual(
+            ['fred.nurke@gmail.com', 'terry.towling@gmail.com'], emails
+        )
+
+    def test_get_user_emails_with_roles_groups(self):
+        clients = fakes.make_fake_clients()
+        project_id = '44444444-1111-1111-1111-111111111111'
+        # The project has a group assignment, which has no user
+        groups = [
+            ra
+            for ra in clients.identity.role_assignments.list(project_id)
+            if ra.group_id
+        ]
+        self.assertEqual(1, len(groups))
+        with self.assertRaises(AttributeError):
+            groups[0].user
+
+        emails = identity.get_user_emails_with_roles(
+            clients.identity, project_id, ['TenantManager']
+        )
+        self.assertEqual(['fred.nurke@gmail.com'], emails)
+        # Only the assignments of the roles asked for are cached
+        self.assertEqual(
+            {
+                '77777777-1111-11111-1111-111111111112': [
+                    '33333333-1111-1111-1111-111111111111'
+                ]
+            },
+            identity.assignment_cache.get(project_id),
+        )
+
+        # Other roles are fetched when they are asked for
+        emails = identity.get_user_emails_with_roles(
+            clients.identity, project_id, ['TenantManager', 'Member']
+        )
+        self.assertEqual(
+            ['fred.nurke@gmail.com', 'terry.towling@gmail.com'], emails
+        )
+        self.assertEqual(
+            [],
+            identity.get_user_emails_with_roles(
+                clients.identity, project_id, ['reader']
+            ),
+        )
+
+    def test_get_user_emails_with_roles_effective(self):
+        # A group of sanandreas' tenant managers
+        assignments = fakes.ASSIGNMENTS + [
+            fakes.FakeRoleAssignment(
+                group_id='55555555-1111-1111-1111-111111111112',
+                project_id='44444444-1111-1111-1111-111111111112',
+                role_id='77777777-1111-11111-1111-111111111112',
+            )
+        ]
+        members = {
+            '55555555-1111-1111-1111-111111111112': [
+                '33333333-1111-1111-1111-111111111112'
+            ]
+        }
+        clients = fakes.make_fake_clients(
+            assignments=assignments, members=members
+        )
+        roles = ['TenantManager', 'Member']
+        emails = identity.get_user_emails_with_roles(
+            clients.identity, '44444444-1111-1111-1111-111111111112', roles
+        )
+        self.assertEqual(
+            ['randy.katz@gmail.com', 'terry.towling@gmail.com'], emails
+        )
+        # The same recipients as the index
+        index = identity.RecipientIndex(roles)
+        index.build(clients.identity)
+        self.assertEqual(
+            emails, index.get('44444444-1111-1111-1111-111111111112')
+        )
+
+    def test_recipient_index(self):
+        clients = fakes.make_fake_clients()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'recipients.json')
+            index = identity.RecipientIndex(
+                ['TenantManager', 'Member'], path=path
+            )
+            index.load()
+            self.assertTrue(index.is_stale())
+            self.assertEqual(3, index.build(clients.identity))
+            self.assertFalse(index.is_stale())
+            self.assertEqual(
+                ['fred.nurke@gmail.com', 'terry.towling@gmail.com'],
+                index.get('44444444-1111-1111-1111-111111111111'),
+            )
+            # A project with no recipients is told apart from one that
+            # isn't indexed
+            self.assertEqual(
+                [], index.get('44444444-1111-1111-1111-111111111113')
+            )
+            self.assertIsNone(index.get('no-such-project'))
+            index.save()
+
+            loaded = identity.RecipientIndex(
+                ['TenantManager', 'Member'], path=path
+            )
+            loaded.load()
+            self.assertEqual(index.timestamp, loaded.timestamp)
+            self.assertEqual(index.projects, loaded.projects)
+
+            # The saved index isn't used for a different set of roles
+            other = identity.RecipientIndex(['Member'], path=path)
+            other.load()
+            self.assertTrue(other.is_stale())
+
+    def test_prefetch(self):
+        clients = fakes.make_fake_clients()
+        identity.project_cache.clear()
+        identity.user_cache.clear()
+        self.assertEqual(
+            (len(fakes.PROJECTS), len(fakes.USERS)),
+            identity.prefetch(clients.identity),
+        )
+        with (
+            mock.patch.object(
+                clients.identity.projects, 'get'
+            ) as mock_get_project,
+            mock.patch.object(clients.identity.users, 'get') as mock_get_user,
+        ):
+            project = identity.get_project(
+                clients.identity,
+                '44444444-1111-1111-1111-111111111112',
+                use_cache=True,
+            )
+            user = identity.get_user(
+                clients.identity,
+                '33333333-1111-1111-1111-111111111113',
+                use_cache=True,
+            )
+        mock_get_project.assert_not_called()
+        mock_get_user.assert_not_called()
+        self.assertEqual('sanandreas', project.name)
+        self.assertEqual('randy.katz@gmail.com', user.email)
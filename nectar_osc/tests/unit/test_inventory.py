@@ -0,0 +1,128 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import datetime
+import os
+import tempfile
+from unittest import mock
+
+from nectar_osc import compute
+from nectar_osc import inventory
+from nectar_osc.tests import test
+from nectar_osc.tests.unit import fakes
+
+
+class TestInventory(test.TestCase):
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'inventory.json')
+
+    def test_refresh_full(self):
+        clients = fakes.make_fake_clients(max_response=1)
+        inv = inventory.Inventory(self.path)
+        inv.load()
+        self.assertTrue(inv.is_stale())
+        self.assertEqual(len(fakes.SERVERS), inv.refresh(clients))
+        self.assertFalse(inv.is_stale())
+        self.assertTrue(os.path.exists(self.path))
+
+        loaded = inventory.Inventory(self.path)
+        loaded.load()
+        self.assertEqual(inv.timestamp, loaded.timestamp)
+        self.assertEqual(list(inv), list(loaded))
+        self.assertEqual(inv.cloud, loaded.cloud)
+        # The identities are left to be resolved when they are used
+        record = loaded.get('00000000-1111-1111-1111-111111111111')
+        self.assertEqual(
+            '44444444-1111-1111-1111-111111111111', record.project
+        )
+        self.assertIsNone(record.project_name)
+
+    def test_refresh_orphan(self):
+        clients = fakes.make_fake_clients(projects=[], users=[])
+        inv = inventory.Inventory(self.path)
+        self.assertEqual(len(fakes.SERVERS), inv.refresh(clients))
+
+    def test_refresh_changes(self):
+        clients = fakes.make_fake_clients()
+        inv = inventory.Inventory(self.path)
+        inv.refresh(clients)
+
+        servers = copy.deepcopy(fakes.SERVERS)
+        servers[0].status = 'DELETED'
+        servers[1].name = 'renamed'
+        clients = fakes.make_fake_clients(servers=servers)
+        clients.compute.servers = mock.Mock(wraps=clients.compute.servers)
+        since = inv.timestamp - inventory.CHANGES_SINCE_MARGIN
+        self.assertEqual(len(servers), inv.refresh(clients))
+        clients.compute.servers.assert_any_call(
+            all_projects=True, changes_since=since.isoformat()
+        )
+        self.assertEqual(len(servers) - 1, len(inv))
+        self.assertIsNone(inv.get(servers[0].id))
+        self.assertEqual('renamed', inv.get(servers[1].id).name)
+
+    def test_refresh_stale(self):
+        clients = fakes.make_fake_clients()
+        inv = inventory.Inventory(self.path)
+        inv.refresh(clients)
+        inv.timestamp -= datetime.timedelta(hours=25)
+        self.assertTrue(inv.is_stale())
+        clients.compute.servers = mock.Mock(wraps=clients.compute.servers)
+        inv.refresh(clients)
+        clients.compute.servers.assert_any_call(all_projects=True)
+
+    def test_refresh_other_cloud(self):
+        clients = fakes.make_fake_clients()
+        inv = inventory.Inventory(self.path)
+        inv.refresh(clients)
+        clients.identity.session = fakes.FakeSession(
+            'https://keystone.other.org:5000/v3/'
+        )
+        clients.compute.servers = mock.Mock(wraps=clients.compute.servers)
+        inv.refresh(clients)
+        clients.compute.servers.assert_any_call(all_projects=True)
+        self.assertEqual('https://keystone.other.org:5000/v3/', inv.cloud)
+
+    def test_extract_from_inventory(self):
+        clients = fakes.make_fake_clients()
+        inv = inventory.Inventory(self.path)
+        inv.refresh(clients)
+        clients.compute.servers = mock.Mock()
+        self.assertEqual(
+            3,
+            len(
+                compute.all_instances(clients, inventory=inv, zones=['danger'])
+            ),
+        )
+        self.assertEqual(
+            1,
+            len(
+                compute.all_instances(
+                    clients, inventory=inv, zones=['danger'], limit=1
+                )
+            ),
+        )
+        self.assertEqual(
+            2,
+            len(
+                compute.all_instances(
+                    clients,
+                    inventory=inv,
+                    project_id='44444444-1111-1111-1111-111111111112',
+                )
+            ),
+        )
+        clients.compute.servers.assert_not_called()
@@ -13,6 +13,8 @@
 from argparse import ArgumentError
 from contextlib import contextmanager
 import datetime
+import io
+import json
 import os
 import shutil
 import sys
@@ -26,7 +28,9 @@ import yaml
 from keystoneclient.exceptions import NotFound
 from nectarclient_lib.exceptions import BadRequest
 
+from nectar_osc import identity
 from nectar_osc import mailout
+from nectar_osc import notifications
 from nectar_osc.tests import test
 from nectar_osc.tests.unit import fakes
 
@@ -246,6 +250,20 @@ class TestMailout(test.TestCase):
                 Exception,
                 'could not be found',
             ),
+            (
+                [
+                    '--start-time',
+                    '09:00 25-06-2015',
+                    '--duration',
+                    '0',
+                    '--template',
+                    '/etc/passwd',
+                    '--ip',
+                    '192.168.1',
+                ],
+                Exception,
+                'Invalid --ip',
+            ),
             (
                 [
                     '--start-time',
@@ -387,12 +405,27 @@ class TestMailout(test.TestCase):
         self.assertEqual(command.timezone, command.end_ts.tzinfo)
         self.assertIsNone(command.user_id)
         self.assertIsNone(command.project_id)
+        self.assertEqual(1, command.list_workers)
+        self.assertEqual(1, command.extract_workers)
+        self.assertEqual(1, command.render_workers)
+        self.assertFalse(command.prefetch_identity)
+        self.assertFalse(command.use_inventory)
+        self.assertFalse(command.use_checkpoint)
 
     def _load(self, path):
         with open(path) as file:
             return yaml.load(file, Loader=yaml.FullLoader)
 
-    def _prep(self, test_workdir):
+    def _journal(self, mailout_dir):
+        "Return the SeqNos recorded in a mailout's send journal"
+
+        path = os.path.join(mailout_dir, 'SENT.journal')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return sorted(json.loads(line)['seqno'] for line in f)
+
+    def _prep(self, test_workdir, store=False):
         "Prepare a workdir for send and clean tests"
 
         mock_app = Mock()
@@ -411,6 +444,8 @@ class TestMailout(test.TestCase):
                 test_template_path,
                 '--subject=To change',
             ]
+            if store:
+                args.append('--store')
             parsed_args = parser.parse_args(args)
             command.take_action(parsed_args)
 
@@ -420,10 +455,29 @@ class TestMailout(test.TestCase):
                 for f in os.listdir(command.mailout_dir)
                 if f.startswith('notification@')
             ]
-            self.assertEqual(2, len(notifications))
+            self.assertEqual(0 if store else 2, len(notifications))
 
         return command.mailout_dir
 
+    def _run_instances(self, test_workdir, extra_args, clients=None):
+        "Run mailout instances with the usual args plus 'extra_args'"
+
+        mock_app = Mock()
+        mock_app.client_manager = clients or fakes.make_fake_clients()
+        with temp_template_file(TEST_TEMPLATE) as test_template_path:
+            command = mailout.Instances(mock_app, Mock())
+            parser = command.get_parser("instances")
+            args = [
+                '--start-time=09:00 25-06-2015',
+                '--duration=1',
+                '--work-dir',
+                test_workdir,
+                '--template',
+                test_template_path,
+            ]
+            command.take_action(parser.parse_args(args + extra_args))
+        return command
+
     def test_instances(self):
         mock_app = Mock()
         mock_app_args = Mock()
@@ -454,6 +508,13 @@ class TestMailout(test.TestCase):
                 self.assertEqual(2, len(notifications))
                 self.assertIn('notification@area54', notifications)
                 self.assertIn('notification@sanandreas', notifications)
+                with open(
+                    os.path.join(command.mailout_dir, 'instances.list')
+                ) as f:
+                    self.assertEqual(
+                        [server.id for server in fakes.SERVERS],
+                        f.read().splitlines(),
+                    )
                 loaded = self._load(
                     os.path.join(command.mailout_dir, 'notification@area54')
                 )
@@ -487,6 +548,182 @@ class TestMailout(test.TestCase):
                     loaded['Context'],
                 )
 
+    def test_instances_prefetch_identity(self):
+        clients = fakes.make_fake_clients()
+        projects = clients.identity.projects
+        with temp_workdir() as test_workdir:
+            with (
+                patch.object(
+                    projects, 'list', wraps=projects.list
+                ) as mock_list,
+                patch.object(projects, 'get') as mock_get,
+            ):
+                command = self._run_instances(
+                    test_workdir, ['--prefetch-identity'], clients
+                )
+            # The owners come from the listings, not per-server lookups
+            mock_list.assert_called_once_with()
+            mock_get.assert_not_called()
+            self.assertEqual(0, identity.user_cache.stats()['misses'])
+            self.assertEqual(['area54', 'sanandreas'], list(command.projects))
+
+    def test_instances_inventory(self):
+        with temp_workdir() as test_workdir:
+            command = self._run_instances(
+                test_workdir, ['--inventory', '--zone=danger']
+            )
+            self.assertTrue(
+                os.path.exists(os.path.join(test_workdir, 'inventory.json'))
+            )
+            self.assertEqual(len(fakes.SERVERS), len(command.inventory))
+            self.assertEqual(['area54', 'sanandreas'], list(command.projects))
+
+    def test_instances_recipient_index(self):
+        clients = fakes.make_fake_clients()
+        ras = clients.identity.role_assignments
+        args = ['--recipient-index', '--zone=danger']
+        with temp_workdir() as test_workdir:
+            with patch.object(ras, 'list', wraps=ras.list) as mock_list:
+                command = self._run_instances(test_workdir, args, clients)
+            # One listing per role, and none per project
+            self.assertEqual(2, mock_list.call_count)
+            path = os.path.join(test_workdir, 'recipients.json')
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(['area54', 'sanandreas'], list(command.projects))
+            self.assertEqual(
+                ['fred.nurke@gmail.com', 'terry.towling@gmail.com'],
+                command.projects['area54']['recipients'],
+            )
+
+            # A project that isn't in the saved index is looked up
+            with open(path) as f:
+                data = json.load(f)
+            del data['projects']['44444444-1111-1111-1111-111111111112']
+            with open(path, 'w') as f:
+                json.dump(data, f)
+            with patch.object(ras, 'list', wraps=ras.list) as mock_list:
+                command = self._run_instances(test_workdir, args, clients)
+            mock_list.assert_called_once_with(
+                project='44444444-1111-1111-1111-111111111112',
+                effective=True,
+                include_names=True,
+            )
+            self.assertEqual(['area54', 'sanandreas'], list(command.projects))
+
+    def test_instances_defer_identity(self):
+        clients = fakes.make_fake_clients()
+        projects = clients.identity.projects
+        with temp_workdir() as test_workdir:
+            with patch.object(projects, 'get', wraps=projects.get) as mock_get:
+                command = self._run_instances(
+                    test_workdir, ['--defer-identity'], clients
+                )
+            self.assertEqual(['area54', 'sanandreas'], list(command.projects))
+            self.assertEqual(
+                INSTANCE_1,
+                dict(command.projects['area54']['instances'][0]),
+            )
+            # One lookup per notified project, and none for the
+            # trove project which has no recipients
+            self.assertEqual(
+                [
+                    call('44444444-1111-1111-1111-111111111111'),
+                    call('44444444-1111-1111-1111-111111111112'),
+                ],
+                mock_get.call_args_list,
+            )
+
+    def test_instances_defer_identity_same_name(self):
+        # Two projects with the same name, e.g. in different domains
+        projects = [
+            fakes.FakeProject(id=p.id, name='area54') for p in fakes.PROJECTS
+        ]
+        clients = fakes.make_fake_clients(projects=projects)
+        with temp_workdir() as test_workdir:
+            for args in ([], ['--defer-identity']):
+                command = self._run_instances(test_workdir, args, clients)
+                self.assertEqual(['area54'], list(command.projects))
+                self.assertEqual(
+                    4, len(command.projects['area54']['instances'])
+                )
+
+    def test_instances_render_workers(self):
+        notifications = []
+        for workers in ('1', '2'):
+            with temp_workdir() as test_workdir:
+                command = self._run_instances(
+                    test_workdir, ['--render-workers', workers]
+                )
+                notifications.append(
+                    {
+                        f: self._load(os.path.join(command.mailout_dir, f))
+                        for f in os.listdir(command.mailout_dir)
+                        if f.startswith('notification@')
+                    }
+                )
+        self.assertEqual(2, len(notifications[1]))
+        self.assertEqual(notifications[0], notifications[1])
+        self.assertEqual(
+            1, notifications[1]['notification@sanandreas']['SeqNo']
+        )
+
+    def test_instances_checkpoint(self):
+        with temp_workdir() as test_workdir:
+            with patch.object(
+                mailout.ListingCheckpoint, 'remove'
+            ) as mock_remove:
+                command = self._run_instances(test_workdir, ['--checkpoint'])
+            mock_remove.assert_called_once_with()
+            path = command.checkpoint_path()
+            self.assertTrue(path.startswith(test_workdir))
+            (records, position) = mailout.ListingCheckpoint(path).load()
+            self.assertEqual(len(fakes.SERVERS), len(records))
+            self.assertEqual(mailout.ListingCheckpoint.COMPLETE, position)
+
+            # A stale checkpoint is discarded rather than resumed
+            with (
+                patch.object(
+                    mailout.ListingCheckpoint, 'is_stale', return_value=True
+                ),
+                patch.object(mailout, 'iter_instances') as mock_iter,
+            ):
+                mock_iter.return_value = iter([])
+                self._run_instances(test_workdir, ['--checkpoint'])
+            self.assertFalse(os.path.exists(path))
+
+            # Records checkpointed with --defer-identity are resolved
+            # when resumed without it
+            with patch.object(mailout.ListingCheckpoint, 'remove'):
+                self._run_instances(
+                    test_workdir, ['--checkpoint', '--defer-identity']
+                )
+            command = self._run_instances(test_workdir, ['--checkpoint'])
+            self.assertEqual(['area54', 'sanandreas'], list(command.projects))
+
+    def test_load_instances(self):
+        mock_app = Mock()
+        mock_app_args = Mock()
+        ids = [
+            '00000000-1111-1111-1111-111111111114',
+            '00000000-1111-1111-1111-111111111112',
+            '00000000-1111-1111-1111-111111111199',
+            '00000000-1111-1111-1111-111111111114',
+            '00000000-1111-1111-1111-111111111111',
+        ]
+        with temp_template_file('\n'.join(ids) + '\n') as ids_file:
+            for workers in (1, 4):
+                command = mailout.Instances(mock_app, mock_app_args)
+                command.clients = fakes.make_fake_clients()
+                command.instances_file = ids_file
+                command.inventory = None
+                command.extract_workers = workers
+                command.defer_identity = False
+                with patch('sys.stdout'):
+                    instances = list(command.load_instances())
+                self.assertEqual(
+                    [ids[0], ids[1], ids[4]], [i['id'] for i in instances]
+                )
+
     def test_cleanup(self):
         mock_app = Mock()
         mock_app_args = Mock()
@@ -550,10 +787,249 @@ class TestMailout(test.TestCase):
                 ],
                 any_order=True,
             )
-            last_path = os.path.join(mailout_dir, 'LAST_SENT')
-            self.assertTrue(os.path.exists(last_path))
-            with open(last_path) as last_file:
-                self.assertEqual('1', last_file.readline())
+            self.assertEqual([0, 1], self._journal(mailout_dir))
+
+    def test_send_store(self):
+        mock_app = Mock()
+        mock_app_args = Mock()
+        mock_taynac = Mock()
+        mock_app.client_manager = fakes.make_fake_clients(taynac=mock_taynac)
+        with temp_workdir() as test_workdir:
+            mailout_dir = self._prep(test_workdir, store=True)
+            self.assertTrue(
+                os.path.exists(
+                    os.path.join(mailout_dir, 'notifications.sqlite')
+                )
+            )
+
+            command = mailout.Send(mock_app, mock_app_args)
+            parser = command.get_parser("send")
+            args = ['--mailout-dir', mailout_dir, "--confirm"]
+            command.take_action(parser.parse_args(args))
+            mock_taynac.messages.send.assert_has_calls(
+                [
+                    call(
+                        subject='To change',
+                        body=ANY,
+                        recipient='fred.nurke@gmail.com',
+                        cc=['terry.towling@gmail.com'],
+                    ),
+                    call(
+                        subject='To change',
+                        body=ANY,
+                        recipient='randy.katz@gmail.com',
+                        cc=[],
+                    ),
+                ]
+            )
+
+    def test_export(self):
+        with temp_workdir() as test_workdir:
+            mailout_dir = self._prep(test_workdir, store=True)
+            export_dir = os.path.join(test_workdir, 'export')
+
+            command = mailout.Export(Mock(), Mock())
+            parser = command.get_parser("export")
+            args = [
+                '--mailout-dir',
+                mailout_dir,
+                '--output-dir',
+                export_dir,
+            ]
+            command.take_action(parser.parse_args(args))
+            self.assertEqual(
+                ['notification@area54', 'notification@sanandreas'],
+                sorted(os.listdir(export_dir)),
+            )
+            loaded = self._load(
+                os.path.join(export_dir, 'notification@sanandreas')
+            )
+            self.assertEqual(1, loaded['SeqNo'])
+            self.assertEqual('To change', loaded['Subject'])
+            self.assertEqual(['randy.katz@gmail.com'], loaded['SendTo'])
+            self.assertEqual(
+                datetime.datetime(2015, 6, 25, 9, 0).astimezone().isoformat(),
+                loaded['Context']['start_ts'],
+            )
+
+            with self.assertRaisesRegex(Exception, 'No notification store'):
+                command.take_action(
+                    parser.parse_args(['--mailout-dir', export_dir])
+                )
+
+    def test_send_concurrently(self):
+        mock_app = Mock()
+        mock_app_args = Mock()
+        mock_taynac = Mock()
+        mock_app.client_manager = fakes.make_fake_clients(taynac=mock_taynac)
+        with temp_workdir() as test_workdir:
+            mailout_dir = self._prep(test_workdir)
+
+            # The second notification is sent, but the first fails
+            def send(recipient, **kwargs):
+                if recipient == 'fred.nurke@gmail.com':
+                    raise BadRequest()
+
+            mock_taynac.messages.send.side_effect = send
+            command = mailout.Send(mock_app, mock_app_args)
+            parser = command.get_parser("send")
+            args = [
+                '--mailout-dir',
+                mailout_dir,
+                '--confirm',
+                '--concurrency=2',
+                '--rate=1000',
+            ]
+            with self.assertRaises(BadRequest):
+                command.take_action(parser.parse_args(args))
+            self.assertEqual(2, mock_taynac.messages.send.call_count)
+            self.assertEqual(1, command.sent)
+            self.assertEqual([1], self._journal(mailout_dir))
+
+            # Only the failed notification is sent on resumption
+            mock_taynac.messages.send.reset_mock()
+            mock_taynac.messages.send.side_effect = None
+            command = mailout.Send(mock_app, mock_app_args)
+            command.take_action(parser.parse_args(args + ['--resume']))
+            self.assertEqual(1, command.sent)
+            mock_taynac.messages.send.assert_called_once_with(
+                subject='To change',
+                body=ANY,
+                recipient='fred.nurke@gmail.com',
+                cc=['terry.towling@gmail.com'],
+            )
+            self.assertEqual([0, 1], self._journal(mailout_dir))
+
+    def test_send_legacy_last_sent(self):
+        mock_app = Mock()
+        mock_app_args = Mock()
+        mock_taynac = Mock()
+        mock_app.client_manager = fakes.make_fake_clients(taynac=mock_taynac)
+        with temp_workdir() as test_workdir:
+            mailout_dir = self._prep(test_workdir)
+            with open(os.path.join(mailout_dir, 'LAST_SENT'), 'w') as f:
+                f.write('0')
+
+            command = mailout.Send(mock_app, mock_app_args)
+            parser = command.get_parser("send")
+            args = ['--mailout-dir', mailout_dir, '--confirm', '--resume']
+            command.take_action(parser.parse_args(args))
+            mock_taynac.messages.send.assert_called_once_with(
+                subject='To change',
+                body=ANY,
+                recipient='randy.katz@gmail.com',
+                cc=[],
+            )
+            self.assertEqual([1], self._journal(mailout_dir))
+            with self.assertRaisesRegex(Exception, 'already been sent'):
+                command.take_action(parser.parse_args(args))
+
+    def test_send_shard(self):
+        mock_app = Mock()
+        mock_app_args = Mock()
+        mock_taynac = Mock()
+        mock_app.client_manager = fakes.make_fake_clients(taynac=mock_taynac)
+        with temp_workdir() as test_workdir:
+            mailout_dir = self._prep(test_workdir)
+
+            command = mailout.Send(mock_app, mock_app_args)
+            parser = command.get_parser("send")
+            args = ['--mailout-dir', mailout_dir, '--confirm']
+            for shard in ['1', '0/0', '2/2', 'a/b']:
+                with self.assertRaisesRegex(Exception, 'Invalid --shard'):
+                    command.take_action(
+                        parser.parse_args(args + ['--shard', shard])
+                    )
+
+            # Another process holds the lock for the shard
+            journal = notifications.SendJournal(
+                os.path.join(mailout_dir, 'SENT-0-of-2.journal')
+            )
+            self.assertTrue(journal.acquire())
+            with self.assertRaisesRegex(Exception, 'Another process'):
+                command.take_action(parser.parse_args(args + ['--shard=0/2']))
+            mock_taynac.messages.send.assert_not_called()
+            journal.release()
+
+            command.take_action(parser.parse_args(args + ['--shard=0/2']))
+            mock_taynac.messages.send.assert_called_once_with(
+                subject='To change',
+                body=ANY,
+                recipient='fred.nurke@gmail.com',
+                cc=['terry.towling@gmail.com'],
+            )
+            self.assertEqual([], self._journal(mailout_dir))
+            self.assertEqual(
+                {'SENT-0-of-2.journal': (0, 2)},
+                notifications.find_journals(mailout_dir),
+            )
+
+            status = mailout.Status(mock_app, mock_app_args)
+            status_parser = status.get_parser("status")
+            (columns, rows) = status.take_action(
+                status_parser.parse_args(['--mailout-dir', mailout_dir])
+            )
+            self.assertEqual(
+                ('Journal', 'Notifications', 'Sent', 'Pending'),
+                columns[:4],
+            )
+            self.assertEqual(
+                [('SENT-0-of-2.journal', 1, 1, 0), ('total', 2, 1, 1)],
+                [row[:4] for row in rows],
+            )
+            self.assertTrue(rows[1][4])
+            self.assertFalse(rows[1][5])
+
+            # An unsharded resume only sends the rest of the mailout
+            mock_taynac.messages.send.reset_mock()
+            command = mailout.Send(mock_app, mock_app_args)
+            command.take_action(parser.parse_args(args + ['--resume']))
+            mock_taynac.messages.send.assert_called_once_with(
+                subject='To change',
+                body=ANY,
+                recipient='randy.katz@gmail.com',
+                cc=[],
+            )
+            (columns, rows) = status.take_action(
+                status_parser.parse_args(['--mailout-dir', mailout_dir])
+            )
+            self.assertEqual(('total', 2, 2, 0), rows[-1][:4])
+
+    def test_send_overlapping_shards(self):
+        mock_app = Mock()
+        mock_app_args = Mock()
+        mock_taynac = Mock()
+        mock_app.client_manager = fakes.make_fake_clients(taynac=mock_taynac)
+        with temp_workdir() as test_workdir:
+            mailout_dir = self._prep(test_workdir)
+            command = mailout.Send(mock_app, mock_app_args)
+            parser = command.get_parser("send")
+            args = ['--mailout-dir', mailout_dir, '--confirm']
+
+            # Another process is sending shard 0 of 2
+            lock = notifications.SendLock(mailout_dir, (0, 2))
+            lock.acquire()
+            for extra in [[], ['--shard=0/3'], ['--shard=1/3']]:
+                with self.assertRaisesRegex(Exception, 'Another process'):
+                    command.take_action(parser.parse_args(args + extra))
+            mock_taynac.messages.send.assert_not_called()
+
+            # The other shard of the same count can be sent
+            command.take_action(parser.parse_args(args + ['--shard=1/2']))
+            mock_taynac.messages.send.assert_called_once_with(
+                subject='To change',
+                body=ANY,
+                recipient='randy.katz@gmail.com',
+                cc=[],
+            )
+            lock.release()
+
+            # An unsharded send stops any shard being sent
+            lock = notifications.SendLock(mailout_dir)
+            lock.acquire()
+            with self.assertRaisesRegex(Exception, 'Another process'):
+                command.take_action(parser.parse_args(args + ['--shard=0/2']))
+            lock.release()
 
     def test_send_to(self):
         mock_app = Mock()
@@ -592,9 +1068,8 @@ class TestMailout(test.TestCase):
                 ],
                 any_order=True,
             )
-            # In '--send-to' mode, LAST_SENT is not updated
-            last_path = os.path.join(mailout_dir, 'LAST_SENT')
-            self.assertFalse(os.path.exists(last_path))
+            # In '--send-to' mode, the journal is not updated
+            self.assertEqual([], self._journal(mailout_dir))
 
     def test_send_fail_and_resume(self):
         mock_app = Mock()
@@ -634,10 +1109,7 @@ class TestMailout(test.TestCase):
                 any_order=True,
             )
 
-            last_path = os.path.join(mailout_dir, 'LAST_SENT')
-            self.assertTrue(os.path.exists(last_path))
-            with open(last_path) as last_file:
-                self.assertEqual('0', last_file.readline())
+            self.assertEqual([0], self._journal(mailout_dir))
 
             # Check the 'already sent' logic
             mock_taynac.messages.send.reset_mock()
@@ -669,8 +1141,7 @@ class TestMailout(test.TestCase):
                 ],
             )
 
-            with open(last_path) as last_file:
-                self.assertEqual('1', last_file.readline())
+            self.assertEqual([0, 1], self._journal(mailout_dir))
 
     @patch('nectar_osc.mailout.query_yes_no')
     def test_send_confirm(self, mock_query_yes_no):
@@ -686,5 +1157,9 @@ class TestMailout(test.TestCase):
             parser = command.get_parser("send")
             args = ['--mailout-dir', mailout_dir]
             parsed_args = parser.parse_args(args)
-            with self.assertRaises(SystemExit):
+            with (
+                self.assertRaises(SystemExit),
+                patch('sys.stdout', new_callable=io.StringIO) as stdout,
+            ):
                 command.take_action(parsed_args)
+            self.assertIn('with 3 recipients in all', stdout.getvalue())
@@ -0,0 +1,137 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+from unittest import mock
+import yaml
+
+from nectar_osc import notifications
+from nectar_osc.tests import test
+
+
+def _notification(seqno, key):
+    return {
+        'SeqNo': seqno,
+        'Key': key,
+        'Subject': f'About {key}',
+        'Body': 'SeqNo: 99\nis not a header when it is in the body',
+        'SendTo': ['fred.nurke@gmail.com'],
+        'Context': {'project_name': key},
+    }
+
+
+class TestNotifications(test.TestCase):
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.mailout_dir = tmp_dir.name
+
+    def _write(self, seqno, key):
+        path = os.path.join(self.mailout_dir, f'notification@{key}')
+        with open(path, 'w') as f:
+            yaml.dump(_notification(seqno, key), f, default_flow_style=False)
+        return path
+
+    def test_index(self):
+        self._write(0, 'area54')
+        path = self._write(1, 'sanandreas')
+
+        index = notifications.open_notifications(self.mailout_dir)
+        self.assertIsInstance(index, notifications.NotificationIndex)
+        self.assertEqual([0, 1], list(index))
+        self.assertIn(1, index)
+        self.assertNotIn(2, index)
+        self.assertEqual(_notification(1, 'sanandreas'), index[1])
+        self.assertEqual(1, index.recipient_count(1))
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(self.mailout_dir, notifications.INDEX_FILENAME)
+            )
+        )
+
+        # The cached index is used without reading the files
+        with mock.patch('builtins.open', wraps=open) as mock_open:
+            index = notifications.open_notifications(self.mailout_dir)
+        mock_open.assert_called_once_with(index.index_path)
+        self.assertEqual([0, 1], list(index))
+
+        # A changed file is indexed again
+        os.unlink(path)
+        self._write(5, 'sanandreas')
+        os.utime(path, ns=(0, 0))
+        index = notifications.open_notifications(self.mailout_dir)
+        self.assertEqual([0, 5], list(index))
+
+    def test_index_header(self):
+        notification = dict(
+            _notification(3, 'area54'),
+            SendTo=['fred.nurke@gmail.com', 'terry.towling@gmail.com'],
+        )
+        path = os.path.join(self.mailout_dir, 'notification@area54')
+        with open(path, 'w') as f:
+            notifications.dump_yaml(notification, f)
+        with open(path) as f:
+            self.assertEqual(notification, yaml.safe_load(f))
+        with open(path) as f:
+            self.assertEqual('SeqNo: 3\n', f.readline())
+
+        # The header is read without parsing the file
+        with mock.patch.object(notifications.yaml, 'load') as mock_load:
+            index = notifications.open_notifications(self.mailout_dir)
+        mock_load.assert_not_called()
+        self.assertEqual([3], list(index))
+        self.assertEqual(2, index.recipient_count(3))
+
+    def test_store(self):
+        path = os.path.join(self.mailout_dir, notifications.STORE_FILENAME)
+        store = notifications.NotificationStore(path)
+        store.add(_notification(0, 'area54'))
+        store.add(_notification(1, 'sanandreas'))
+        with self.assertRaisesRegex(Exception, 'already exists'):
+            store.add(_notification(2, 'area54'))
+        store.close()
+
+        store = notifications.open_notifications(self.mailout_dir)
+        self.assertIsInstance(store, notifications.NotificationStore)
+        self.assertEqual(2, len(store))
+        self.assertEqual([0, 1], list(store))
+        self.assertIn(1, store)
+        self.assertNotIn(2, store)
+        self.assertEqual(_notification(1, 'sanandreas'), store[1])
+        self.assertEqual(1, store.recipient_count(1))
+        self.assertEqual(
+            ['area54', 'sanandreas'],
+            [n['Key'] for n in store.notifications()],
+        )
+        store.close()
+
+    def test_journal(self):
+        path = os.path.join(self.mailout_dir, notifications.JOURNAL_FILENAME)
+        journal = notifications.SendJournal(path, sync_every=2)
+        self.assertEqual({}, journal.load())
+        with mock.patch.object(notifications.os, 'fsync') as mock_fsync:
+            journal.record(3, 'message-3')
+            journal.record(1)
+            journal.record(2, 'message-2')
+            self.assertEqual(1, mock_fsync.call_count)
+            journal.close()
+            self.assertEqual(2, mock_fsync.call_count)
+        # A line truncated by a crash is ignored
+        with open(path, 'a') as f:
+            f.write('{"seqno": 4, "ti')
+
+        entries = notifications.SendJournal(path).load()
+        self.assertEqual([3, 1, 2], list(entries))
+        self.assertEqual('message-3', entries[3]['id'])
+        self.assertIsNone(entries[1]['id'])
@@ -14,7 +14,9 @@ from io import StringIO
 import unittest
 from unittest.mock import patch
 
+from nectar_osc.util import IPMatcher
 from nectar_osc.util import query_yes_no
+from nectar_osc.util import TokenBucket
 
 
 class TestUtil(unittest.TestCase):
@@ -112,3 +114,46 @@ class TestUtil(unittest.TestCase):
         # Bad default
         with self.assertRaises(ValueError):
             query_yes_no("Some question", default="weeble")
+
+    def test_ip_matcher(self):
+        matcher = IPMatcher(
+            ['10.0.0.1', '10.1.0.0/16', '10.1.2.0/24', '2001:db8::/32']
+        )
+        self.assertIn('10.0.0.1', matcher)
+        self.assertNotIn('10.0.0.12', matcher)
+        self.assertNotIn('10.0.0.0', matcher)
+        self.assertIn('10.1.0.0', matcher)
+        self.assertIn('10.1.255.255', matcher)
+        self.assertNotIn('10.2.0.0', matcher)
+        self.assertIn('2001:db8::1', matcher)
+        self.assertNotIn('2001:db9::1', matcher)
+        self.assertNotIn('not-an-address', matcher)
+        self.assertTrue(matcher.match_any(['192.168.1.1', '10.1.3.4']))
+        self.assertFalse(matcher.match_any(['192.168.1.1']))
+        self.assertIsNone(matcher.addresses())
+        self.assertEqual(
+            ['10.0.0.1', '2001:db8::1'],
+            IPMatcher(['10.0.0.1', '2001:db8:0::1']).addresses(),
+        )
+        with self.assertRaises(ValueError):
+            IPMatcher(['10.0.0.300'])
+
+    def test_token_bucket(self):
+        now = [100.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        with (
+            patch(
+                'nectar_osc.util.time.monotonic', side_effect=lambda: now[0]
+            ),
+            patch('nectar_osc.util.time.sleep', side_effect=sleep),
+        ):
+            bucket = TokenBucket(rate=2, burst=2)
+            for _ in range(4):
+                bucket.acquire()
+        # The burst is used up first, then tokens arrive every 1/2 second
+        self.assertEqual([0.5, 0.5], sleeps)
@@ -11,8 +11,12 @@
 #   under the License.
 #
 
+import bisect
+import ipaddress
 import re
 import sys
+import threading
+import time
 
 
 def _get_input():
@@ -59,3 +63,87 @@ def normalize_filename(filename):
     for c in illegal_chars:
         filename = re.sub(c, '_', filename)
     return filename
+
+
+def cloud_url(identity):
+    """Return the auth URL that identifies the cloud of an identity client
+
+    Returns None if the client doesn't have one.
+    """
+
+    auth = getattr(getattr(identity, 'session', None), 'auth', None)
+    return getattr(auth, 'auth_url', None)
+
+
+class IPMatcher:
+    """Match IP addresses against a collection of addresses and networks
+
+    The addresses and CIDRs are merged into sorted, non-overlapping
+    intervals (one list per IP version) when the matcher is built, so
+    that each lookup is a binary search.  Raises ValueError if any of
+    'specs' is not a valid address or network.
+    """
+
+    def __init__(self, specs):
+        self.networks = [
+            ipaddress.ip_network(spec.strip(), strict=False) for spec in specs
+        ]
+        self.starts = {}
+        self.ends = {}
+        for version in (4, 6):
+            merged = ipaddress.collapse_addresses(
+                n for n in self.networks if n.version == version
+            )
+            intervals = [
+                (int(n.network_address), int(n.broadcast_address))
+                for n in merged
+            ]
+            self.starts[version] = [start for (start, _) in intervals]
+            self.ends[version] = [end for (_, end) in intervals]
+
+    def __contains__(self, address):
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        value = int(ip)
+        i = bisect.bisect_right(self.starts[ip.version], value) - 1
+        return i >= 0 and value <= self.ends[ip.version][i]
+
+    def match_any(self, addresses):
+        return any(address in self for address in addresses)
+
+    def addresses(self):
+        """Return the specs as addresses if none of them are networks"""
+        if all(n.num_addresses == 1 for n in self.networks):
+            return [str(n.network_address) for n in self.networks]
+        return None
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter
+
+    acquire() blocks until a token is available.  Tokens accumulate at
+    'rate' per second, up to 'burst' of them.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)